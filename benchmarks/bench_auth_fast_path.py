@@ -0,0 +1,59 @@
+"""Compare /auth throughput of the Flask route and the raw WSGI fast path.
+
+The WSGI application is called in-process, so the numbers measure the
+cost of nslogind's request handling without any HTTP server.
+
+    python benchmarks/bench_auth_fast_path.py [--requests 50000]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from werkzeug.test import EnvironBuilder  # noqa: E402
+
+from nslogin import nslogind  # noqa: E402
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def run(wsgi_app, environ, requests):
+    start = time.perf_counter()
+    for _ in range(requests):
+        body = wsgi_app(dict(environ), start_response)
+        for _ in body:
+            pass
+        if hasattr(body, 'close'):
+            body.close()
+    return requests / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=50000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    nslogind.setup({'user_table': os.path.join(workdir, 'users.yaml')})
+    nslogind.user_table.add_user('bench', 'bench', ['a'])
+    token = nslogind.session_store.new_session('bench', time.time()).token
+
+    fast_path = nslogind.app.wsgi_app
+    flask_path = fast_path.app
+
+    for privileges, label in (('a', '200'), ('b', '403')):
+        environ = EnvironBuilder(path=f'/auth/{privileges}',
+                                 headers={'Cookie': f'token={token}'}).get_environ()
+        flask_rps = run(flask_path, environ, args.requests)
+        fast_rps = run(fast_path, environ, args.requests)
+        print(f"/auth/{privileges} ({label}): flask {flask_rps:,.0f} req/s, "
+              f"fast path {fast_rps:,.0f} req/s ({fast_rps / flask_rps:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
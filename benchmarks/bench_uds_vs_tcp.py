@@ -0,0 +1,103 @@
+"""Compare /auth latency over loopback TCP and a Unix domain socket.
+
+nslogind's development server is started in a child process, listening on
+both, and /auth is requested sequentially, once with a new connection per
+request (nginx's default for proxy_pass) and once over a kept-alive one.
+
+    python benchmarks/bench_uds_vs_tcp.py [--requests 5000]
+"""
+import os
+import sys
+import time
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import http.client
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from nslogin import nslogind  # noqa: E402
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def serve(workdir, port, socket_path, token_queue):
+    from werkzeug.serving import make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    nslogind.setup({'user_table': os.path.join(workdir, 'users.yaml')})
+    nslogind.user_table.add_user('bench', 'bench', ['a'])
+    token_queue.put(nslogind.session_store.new_session('bench', time.time()).token)
+
+    tcp = make_server('127.0.0.1', port, nslogind.app, threaded=True)
+    uds = make_server(f'unix://{socket_path}', 0, nslogind.app, threaded=True)
+    threading.Thread(target=uds.serve_forever, daemon=True).start()
+    tcp.serve_forever()
+
+
+def percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+
+def measure(new_connection, token, requests, keep_alive):
+    latencies = []
+    conn = new_connection()
+    for _ in range(requests):
+        if not keep_alive:
+            conn = new_connection()
+        start = time.perf_counter()
+        conn.request('GET', '/auth/a', headers={'Cookie': f'token={token}'})
+        response = conn.getresponse()
+        response.read()
+        latencies.append((time.perf_counter() - start) * 1e6)
+        if not keep_alive:
+            conn.close()
+    latencies.sort()
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--port", type=int, default=18222)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    socket_path = os.path.join(workdir, 'nslogind.sock')
+    token_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, daemon=True,
+                                     args=(workdir, args.port, socket_path, token_queue))
+    server.start()
+    token = token_queue.get(timeout=30)
+    while not os.path.exists(socket_path):
+        time.sleep(0.05)
+    time.sleep(0.2)
+
+    transports = {
+        'tcp': lambda: http.client.HTTPConnection('127.0.0.1', args.port),
+        'uds': lambda: UnixHTTPConnection(socket_path),
+    }
+    for keep_alive in (False, True):
+        for name, new_connection in transports.items():
+            measure(new_connection, token, min(500, args.requests), keep_alive)
+            latencies = measure(new_connection, token, args.requests, keep_alive)
+            print(f"{name} {'keep-alive' if keep_alive else 'new connection'}: "
+                  f"p50 {percentile(latencies, 50):.0f} us, "
+                  f"p99 {percentile(latencies, 99):.0f} us")
+
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main()
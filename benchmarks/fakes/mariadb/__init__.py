@@ -0,0 +1,130 @@
+"""A stand-in for the `mariadb` module, backed by SQLite, so that the MySQL
+backend can be benchmarked without a database server.
+
+Put `benchmarks/fakes` in front of sys.path (or PYTHONPATH). Databases are
+SQLite files `<FAKE_MARIADB_DIR>/<database>.sqlite`, and every statement
+sleeps `FAKE_MARIADB_LATENCY` seconds to stand for the network round trip.
+"""
+import os
+import time
+import sqlite3
+
+
+class Error(Exception):
+    pass
+
+
+class InterfaceError(Error):
+    pass
+
+
+class OperationalError(Error):
+    pass
+
+
+class IntegrityError(Error):
+    pass
+
+
+def database_path(database):
+    return os.path.join(os.environ.get('FAKE_MARIADB_DIR', '.'), f"{database}.sqlite")
+
+
+def create_user_table(database, table):
+    conn = sqlite3.connect(database_path(database))
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS `{table}` (
+              `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+              `username` varchar(255) NOT NULL UNIQUE,
+              `realname` varchar(255) NOT NULL,
+              `password` varchar(255) NOT NULL,
+              `salt` varchar(255) DEFAULT NULL,
+              `ip` varchar(40) DEFAULT NULL,
+              `lastlogin` bigint(20) DEFAULT NULL,
+              `web_privileges` varchar(255) DEFAULT NULL
+        )""")
+    conn.commit()
+    conn.close()
+
+
+class Cursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.conn.cursor()
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def execute(self, sql, params=()):
+        self.connection.round_trip()
+        # SQLite has no row locks, writers are serialized by begin() instead.
+        sql = sql.replace(" FOR UPDATE", "")
+        try:
+            self.cursor.execute(sql, params)
+        except sqlite3.OperationalError as e:
+            raise OperationalError(str(e))
+        except sqlite3.IntegrityError as e:
+            raise IntegrityError(str(e))
+
+    def executemany(self, sql, seq_of_params):
+        self.connection.round_trip()
+        try:
+            self.cursor.executemany(sql, seq_of_params)
+        except sqlite3.OperationalError as e:
+            raise OperationalError(str(e))
+        except sqlite3.IntegrityError as e:
+            raise IntegrityError(str(e))
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def close(self):
+        self.cursor.close()
+
+
+class Connection:
+    def __init__(self, database, autocommit=False, **kwargs):
+        self.latency = float(os.environ.get('FAKE_MARIADB_LATENCY', 0))
+        self.conn = sqlite3.connect(database_path(database), timeout=30,
+                                    check_same_thread=False,
+                                    isolation_level=None if autocommit else 'DEFERRED')
+        self.closed = False
+
+    def round_trip(self):
+        if self.closed:
+            raise InterfaceError("Connection is closed.")
+        if self.latency:
+            time.sleep(self.latency)
+
+    def cursor(self, **kwargs):
+        return Cursor(self)
+
+    def commit(self):
+        self.round_trip()
+        if self.conn.in_transaction:
+            self.conn.commit()
+
+    def rollback(self):
+        self.round_trip()
+        if self.conn.in_transaction:
+            self.conn.rollback()
+
+    def begin(self):
+        self.round_trip()
+        self.conn.execute("BEGIN IMMEDIATE")
+
+    def ping(self):
+        self.round_trip()
+
+    def close(self):
+        self.closed = True
+        self.conn.close()
+
+
+def connect(user=None, password=None, database=None, host=None, port=None, **kwargs):
+    return Connection(database, **kwargs)
@@ -0,0 +1,5 @@
+# Only what nslogin uses of `mariadb.constants`.
+
+
+class CLIENT:
+    FOUND_ROWS = 2
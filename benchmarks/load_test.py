@@ -0,0 +1,317 @@
+"""Drive nslogind with a mix of /auth checks, logins, registrations and
+password changes, and report throughput and latency percentiles as JSON.
+
+nslogind runs either in-process (its WSGI application is called directly,
+measuring the request handling alone) or as a subprocess serving HTTP. The
+user table is a YAML file or the MySQL backend on top of the SQLite-backed
+fake `mariadb` module in benchmarks/fakes.
+
+    python benchmarks/load_test.py --backend yaml --mix mixed --duration 10
+    python benchmarks/load_test.py --backend mysql --db-latency 0.0005 \\
+        --mode subprocess --concurrency 16 --output mysql.json
+
+Runs are reproducible for a given --seed, apart from the timing itself.
+"""
+import os
+import sys
+import json
+import time
+import yaml
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlencode
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+FAKES_DIR = os.path.join(BENCHMARKS_DIR, 'fakes')
+
+sys.path.insert(0, REPO_DIR)
+
+# Operation weights.
+MIXES = {
+    'auth': {'auth_cookie': 70, 'auth_uri': 20, 'auth_denied': 10},
+    'mixed': {'auth_cookie': 60, 'auth_uri': 15, 'auth_denied': 10,
+              'login': 8, 'register': 4, 'change_password': 3},
+    'login_storm': {'login': 70, 'auth_cookie': 30},
+}
+
+PASSWORD = 'bench-password'
+FORM_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+
+def get_config(args, workdir):
+    config = {
+        'user_table': os.path.join(workdir, 'users.yaml'),
+        'register': {'enabled': True},
+        'login_rate_limit': {'enabled': False},
+        'auth_cache': {'enabled': not args.no_auth_cache},
+        'session': {'backend': args.session_backend,
+                    'path': os.path.join(workdir, 'sessions.sqlite'),
+                    'secret': 'bench'},
+    }
+    if args.cheap_hash:
+        config['password'] = {'algorithm': 'pbkdf2-sha256', 'pbkdf2_iterations': 1000}
+    if args.backend == 'mysql':
+        config['db_backend'] = 'mysql'
+        config['mysql'] = {'host': '127.0.0.1', 'port': 3306, 'user': 'bench',
+                           'password': 'bench', 'database': 'bench', 'table': 'users',
+                           'pool': {'max_size': args.concurrency}}
+    return config
+
+
+def prepare_storage(args, config, workdir):
+    os.environ['FAKE_MARIADB_DIR'] = workdir
+    os.environ['FAKE_MARIADB_LATENCY'] = str(args.db_latency)
+    if args.backend == 'mysql':
+        sys.path.insert(0, FAKES_DIR)
+        import mariadb
+        mariadb.create_user_table('bench', 'users')
+
+    from nslogin.storage import get_user_table
+
+    user_table = get_user_table(config)
+    for i in range(args.concurrency):
+        user_table.add_user(f'bench{i}', PASSWORD, ['bench'])
+    user_table.close()
+
+
+class InProcessClient:
+    def __init__(self, app):
+        from werkzeug.test import Client
+        self.client = Client(app, use_cookies=False)
+
+    def request(self, method, path, headers, body=None):
+        response = self.client.open(path, method=method, headers=headers, data=body)
+        response.close()
+        return response.status_code, response.headers.get('Set-Cookie')
+
+
+class HttpClient:
+    def __init__(self, port):
+        self.port = port
+        self.conn = http.client.HTTPConnection('127.0.0.1', port)
+
+    def request(self, method, path, headers, body=None):
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+        except (http.client.HTTPException, ConnectionError):
+            self.conn.close()
+            self.conn = http.client.HTTPConnection('127.0.0.1', self.port)
+            raise
+        response.read()
+        return response.status, response.getheader('Set-Cookie')
+
+
+def token_of(set_cookie):
+    if set_cookie and set_cookie.startswith('token='):
+        return set_cookie.split(';', 1)[0][len('token='):]
+    return None
+
+
+class Worker:
+    """Issues operations as bench<index>, keeping its latest session."""
+
+    def __init__(self, index, client, rng):
+        self.user = f'bench{index}'
+        self.client = client
+        self.rng = rng
+        self.token = None
+        self.registered = 0
+        self.index = index
+
+    def login(self):
+        status, set_cookie = self.client.request(
+            'POST', '/login', FORM_HEADERS,
+            urlencode({'user': self.user, 'password': PASSWORD}))
+        self.token = token_of(set_cookie) or self.token
+        return status, 200
+
+    def auth_cookie(self):
+        status, _ = self.client.request('GET', '/auth/bench', {'Cookie': f'token={self.token}'})
+        return status, 200
+
+    def auth_uri(self):
+        status, _ = self.client.request('GET', '/auth/bench',
+                                        {'X-Original-URI': f'/private/?token={self.token}'})
+        return status, 200
+
+    def auth_denied(self):
+        status, _ = self.client.request('GET', '/auth/admin', {'Cookie': f'token={self.token}'})
+        return status, 403
+
+    def register(self):
+        self.registered += 1
+        status, _ = self.client.request(
+            'POST', '/register', FORM_HEADERS,
+            urlencode({'user': f'new{self.index}x{self.registered}x{self.rng.randrange(10 ** 9)}',
+                       'password': PASSWORD, 'invitation': ''}))
+        return status, 200
+
+    def change_password(self):
+        # To the same password, so that the other operations keep working.
+        status, set_cookie = self.client.request(
+            'POST', '/changepassword', dict(FORM_HEADERS, Cookie=f'token={self.token}'),
+            urlencode({'user': self.user, 'old-password': PASSWORD, 'new-password': PASSWORD}))
+        self.token = token_of(set_cookie) or self.token
+        return status, 200
+
+
+def run_worker(worker, mix, deadline, requests, results):
+    operations = list(mix)
+    weights = [mix[operation] for operation in operations]
+    latencies = {operation: [] for operation in operations}
+    errors = {operation: 0 for operation in operations}
+
+    worker.login()
+    done = 0
+    while time.monotonic() < deadline and (not requests or done < requests):
+        operation = worker.rng.choices(operations, weights)[0]
+        start = time.perf_counter()
+        try:
+            status, expected = getattr(worker, operation)()
+            failed = status != expected
+        except (http.client.HTTPException, ConnectionError):
+            failed = True
+        latencies[operation].append(time.perf_counter() - start)
+        errors[operation] += failed
+        done += 1
+
+    results.append((latencies, errors))
+
+
+def percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+
+def summarize(latencies, errors, elapsed):
+    if not latencies:
+        return {'count': 0, 'errors': errors}
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'errors': errors,
+        'throughput': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3),
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_subprocess(config, workdir, args):
+    port = free_port()
+    config = dict(config, host='127.0.0.1', port=port)
+    if args.server:
+        config['server'] = {'mode': args.server}
+    config_path = os.path.join(workdir, 'config.yaml')
+    with open(config_path, 'w') as f:
+        yaml.safe_dump(config, f)
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [FAKES_DIR, REPO_DIR, os.environ.get('PYTHONPATH', '')]))
+    server = subprocess.Popen([sys.executable, '-m', 'nslogin.nslogind', '-c', config_path],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server, port
+        except OSError:
+            if server.poll() is not None:
+                raise RuntimeError("nslogind exited during startup.")
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("nslogind didn't start listening.")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", choices=['yaml', 'mysql'], default='yaml')
+    parser.add_argument("--mode", choices=['inprocess', 'subprocess'], default='inprocess')
+    parser.add_argument("--server", choices=['development', 'prefork', 'asgi'],
+                        help="server.mode of the subprocess")
+    parser.add_argument("--mix", choices=sorted(MIXES), default='mixed')
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--requests", type=int, default=0,
+                        help="stop each worker after this many requests (0 = no limit)")
+    parser.add_argument("--db-latency", type=float, default=0.0,
+                        help="seconds added to every fake MariaDB statement")
+    parser.add_argument("--session-backend", choices=['memory', 'sqlite', 'signed'],
+                        default='memory')
+    parser.add_argument("--no-auth-cache", action='store_true')
+    parser.add_argument("--cheap-hash", action='store_true',
+                        help="use cheap password hashes, to measure everything else")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='nslogin-bench-')
+    config = get_config(args, workdir)
+    prepare_storage(args, config, workdir)
+
+    server = None
+    if args.mode == 'inprocess':
+        from nslogin import nslogind
+        nslogind.setup(config)
+        new_client = lambda: InProcessClient(nslogind.app)  # noqa: E731
+    else:
+        server, port = start_subprocess(config, workdir, args)
+        new_client = lambda: HttpClient(port)  # noqa: E731
+
+    mix = MIXES[args.mix]
+    results = []
+    try:
+        deadline = time.monotonic() + args.duration
+        threads = [threading.Thread(target=run_worker, args=(
+            Worker(i, new_client(), random.Random(args.seed * 1000 + i)),
+            mix, deadline, args.requests, results)) for i in range(args.concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    report = {
+        'parameters': {key: value for key, value in vars(args).items() if key != 'output'},
+        'python': sys.version.split()[0],
+        'elapsed': round(elapsed, 3),
+        'operations': {},
+    }
+    all_latencies = []
+    all_errors = 0
+    for operation in mix:
+        latencies = [latency for result in results for latency in result[0][operation]]
+        errors = sum(result[1][operation] for result in results)
+        report['operations'][operation] = summarize(latencies, errors, elapsed)
+        all_latencies += latencies
+        all_errors += errors
+    report['total'] = summarize(all_latencies, all_errors, elapsed)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
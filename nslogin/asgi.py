@@ -0,0 +1,196 @@
+import io
+import time
+
+from werkzeug.formparser import parse_form_data
+from werkzeug.http import dump_cookie
+
+from nslogin.utils.auth_fast_path import TOKEN_IN_COOKIE_REGEX, TOKEN_IN_URI_REGEX
+from nslogin.utils.request_tracing import RequestTracing
+
+LOGIN_PATHS = ('/', '/login', '/login/')
+MAX_FORM_SIZE = 64 * 1024
+
+
+class AsgiAuthApp:
+    """ASGI application answering /auth and the login form on the event
+    loop, querying an AsyncUserTable, so that requests waiting for the
+    database don't hold threads. Every other request goes to the Flask
+    `app` through asgiref's WsgiToAsgi.
+
+    The decisions are made by the functions the Flask views use
+    (start_auth(), finish_auth(), allow_login(), finish_login()), only
+    the user table calls are awaited here.
+
+    :param app: the WSGI application
+    :param state: the nslogind module, after setup()
+    :param user_table: the AsyncUserTable
+    """
+
+    def __init__(self, app, state, user_table):
+        from asgiref.wsgi import WsgiToAsgi
+
+        self.fallback = WsgiToAsgi(app)
+        self.state = state
+        self.user_table = user_table
+        self.forbidden_body = state.forbidden_page.encode('utf-8')
+
+        # Cached decisions follow the changes made through this table too.
+        # Sessions of a deleted user need no listener: /auth answers 401
+        # once the user is gone.
+        if state.auth_cache:
+            user_table.add_change_listener(state.auth_cache.invalidate_user)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        headers = {}
+        for name, value in scope['headers']:
+            headers[name.decode('latin-1')] = value.decode('latin-1')
+
+        path = scope['path']
+        script_name = headers.get('x-script-name')
+        if script_name and path.startswith(script_name):
+            path = path[len(script_name):]
+
+        start = time.perf_counter()
+        if path == '/auth' or path == '/auth/':
+            status = await self.auth('default', scope, headers, send)
+            self.record('auth', scope, status, start)
+        elif path.startswith('/auth/'):
+            status = await self.auth(path[6:], scope, headers, send)
+            self.record('auth', scope, status, start)
+        elif path in LOGIN_PATHS and scope['method'] == 'POST':
+            status = await self.login(scope, headers, receive, send)
+            self.record('verify_login', scope, status, start)
+        else:
+            await self.fallback(scope, receive, send)
+
+    def record(self, endpoint, scope, status, start):
+        # The request metrics and slow request log of the WSGI side. Phases
+        # are not traced: the tracer is per thread, and the event loop runs
+        # the requests concurrently in one.
+        state = self.state
+        duration = time.perf_counter() - start
+        if state.metrics:
+            state.record_request_metrics(endpoint, status, duration)
+
+        threshold = state.tracer.threshold
+        if threshold is not None and duration >= threshold:
+            RequestTracing.log({'REQUEST_METHOD': scope['method'], 'PATH_INFO': scope['path']},
+                               str(status), duration, {})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.user_table.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    def get_token(headers):
+        cookie = headers.get('cookie')
+        if cookie:
+            match = TOKEN_IN_COOKIE_REGEX.search(cookie)
+            if match:
+                return match[1]
+
+        original_uri = headers.get('x-original-uri')
+        if original_uri:
+            match = TOKEN_IN_URI_REGEX.search(original_uri)
+            if match:
+                return match[1]
+
+        return None
+
+    @staticmethod
+    def get_remote_addr(scope, headers):
+        if 'x-real-ip' in headers:
+            return headers['x-real-ip']
+        return scope['client'][0] if scope.get('client') else None
+
+    async def check_auth(self, token, privileges, remote_addr):
+        # nslogind.check_auth(), awaiting the user table.
+        check = self.state.start_auth(token, privileges, remote_addr)
+        if isinstance(check, int):
+            return check
+
+        try:
+            allowed = await self.user_table.verify_user_privileges(check.login.user, privileges)
+        except ValueError:
+            allowed = None
+        return self.state.finish_auth(check, allowed)
+
+    async def auth(self, privileges, scope, headers, send):
+        status = await self.check_auth(self.get_token(headers), privileges,
+                                       self.get_remote_addr(scope, headers))
+        if status == 403:
+            await self.respond(send, 403, self.forbidden_body,
+                               [(b'content-type', b'text/html; charset=utf-8')])
+        else:
+            await self.respond(send, status)
+        return status
+
+    async def login(self, scope, headers, receive, send):
+        body = await self.read_body(receive)
+        if body is None:
+            await self.respond(send, 413)
+            return 413
+
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': headers.get('content-type', ''),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': io.BytesIO(body),
+        }
+        _, form, _ = parse_form_data(environ)
+        remote_addr = self.get_remote_addr(scope, headers)
+
+        if 'user' in form and 'password' in form:
+            user = form['user']
+            password = form['password']
+            state = self.state
+
+            if not state.allow_login(user, remote_addr):
+                await self.respond(send, 429, b'too many attempts')
+                return 429
+
+            authenticated = await self.user_table.authenticate(user, password, remote_addr,
+                                                               int(time.time()))
+            login = state.finish_login(user, remote_addr, authenticated)
+            if login:
+                cookie = dump_cookie('token', login.token,
+                                     expires=time.time() + state.config.get('login_life_time',
+                                                                            24 * 3600))
+                await self.respond(send, 200,
+                                   headers=[(b'set-cookie', cookie.encode('latin-1'))])
+                return 200
+
+        await self.respond(send, 403)
+        return 403
+
+    @staticmethod
+    async def read_body(receive):
+        body = bytearray()
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if len(body) > MAX_FORM_SIZE:
+                return None
+            if not message.get('more_body'):
+                return bytes(body)
+
+    @staticmethod
+    async def respond(send, status, body=b'', headers=()):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-length', str(len(body)).encode())] + list(headers),
+        })
+        await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,75 @@
+// Runs after webpack: names the scripts and the stylesheet in static/ after
+// their content, so that they can be cached forever, writes .gz and .br
+// versions next to them, and static/manifest.json, which maps e.g.
+// 'js/login.js' to 'js/login.<hash>.js' for the asset() helper of the
+// templates.
+//
+// `node build-assets.cjs --clean` only removes the output of a previous run,
+// so that the plain names written by `webpack --watch` are used.
+const crypto = require('crypto');
+const fs = require('fs');
+const path = require('path');
+const zlib = require('zlib');
+
+const staticDir = path.resolve(__dirname, 'static');
+const directories = ['js', 'css'];
+const assetName = /^[^.]+\.(js|css)$/;
+const hashedName = /\.[0-9a-f]{8}\.(js|css)(\.gz|\.br)?$/;
+
+const threshold = 1024;
+const minRatio = 0.9;
+const compressors = {
+  '.gz': (data) => zlib.gzipSync(data, { level: 9 }),
+  '.br': (data) => zlib.brotliCompressSync(data, {
+    params: { [zlib.constants.BROTLI_PARAM_QUALITY]: 11 },
+  }),
+};
+
+function clean() {
+  fs.rmSync(path.join(staticDir, 'manifest.json'), { force: true });
+  for (const dir of directories) {
+    for (const file of fs.readdirSync(path.join(staticDir, dir))) {
+      if (hashedName.test(file)) {
+        fs.unlinkSync(path.join(staticDir, dir, file));
+      }
+    }
+  }
+}
+
+function build() {
+  const manifest = {};
+
+  for (const dir of directories) {
+    for (const file of fs.readdirSync(path.join(staticDir, dir)).sort()) {
+      if (!assetName.test(file)) {
+        continue;
+      }
+
+      const data = fs.readFileSync(path.join(staticDir, dir, file));
+      const hash = crypto.createHash('sha256').update(data).digest('hex').slice(0, 8);
+      const ext = path.extname(file);
+      const hashed = `${path.basename(file, ext)}.${hash}${ext}`;
+
+      fs.renameSync(path.join(staticDir, dir, file), path.join(staticDir, dir, hashed));
+      manifest[`${dir}/${file}`] = `${dir}/${hashed}`;
+
+      if (data.length < threshold) {
+        continue;
+      }
+      for (const [suffix, compress] of Object.entries(compressors)) {
+        const compressed = compress(data);
+        if (compressed.length / data.length < minRatio) {
+          fs.writeFileSync(path.join(staticDir, dir, hashed + suffix), compressed);
+        }
+      }
+    }
+  }
+
+  fs.writeFileSync(path.join(staticDir, 'manifest.json'),
+                   JSON.stringify(manifest, null, 2) + '\n');
+}
+
+clean();
+if (!process.argv.includes('--clean')) {
+  build();
+}
@@ -1,68 +1,148 @@
-import re
 import os
+import sys
 import time
+import atexit
+import signal
 import logging
 import argparse
 import yaml
-import secrets
 from collections import namedtuple
 from flask import (Flask, abort, request, render_template, make_response,
-                   redirect, escape)
+                   redirect, escape, g)
+from werkzeug.http import generate_etag
 
+from nslogin.server import run_development, run_prefork, run_asgi
 from nslogin.utils.misc import safeget
+from .utils.auth_cache import AuthCache
+from .utils.auth_fast_path import AuthFastPath, TOKEN_IN_URI_REGEX
+from .utils.invitation_codes import InvitationCodeStore
+from .utils.metrics import Metrics, TimedUserTable
+from .utils.profiler import SamplingProfiler
+from .utils.rate_limit import LoginRateLimit
+from .utils.request_tracing import RequestTracer, RequestTracing
 from .utils.reverse_proxied import ReverseProxied
-from nslogin.storage import get_user_table, UserTable
+from .utils.static_assets import StaticAssets
+from nslogin.storage import get_user_table, check_user_name, UserTable
+from nslogin.session import get_session_store, SessionStore
 
-LoginTokenRecord = namedtuple('LoginTokenRecord', ['user', 'token', 'login_at'])
-
-app = Flask(__name__)
+# Static files are served by static_file() below.
+app = Flask(__name__, static_folder=None)
 
 config = {}
 user_table: UserTable
-login_token_record = {}
+session_store: SessionStore
+auth_cache = None
+static_assets = None
+login_rate_limit = None
+invitation_codes = None
+metrics = None
+profiler = None
+# Records phases only while RequestTracing, set up by setup_profiling(),
+# traces a request.
+tracer = RequestTracer()
+forbidden_page = ""
+
+Page = namedtuple('Page', ['body', 'etag'])
+AuthCheck = namedtuple('AuthCheck', ['token', 'privileges', 'remote_addr', 'login',
+                                     'generation'])
+REDIRECT_PLACEHOLDER = "__nslogin_redirect__"
+pages = {}
+login_templates = {}
 
 logger = logging.getLogger("login")
 
 
-def get_login_record():
-    token = ""
-
+def get_token():
     if 'token' in request.cookies:
-        token = request.cookies['token']
-    else:
-        if 'X-Original-URI' in request.headers:
-            match = re.findall("token=(.*)&?", request.headers['X-Original-URI'])
-            if not match:
-                return None
-            token = match[0]
-        else:
-            return None
+        return request.cookies['token']
 
-    if token not in login_token_record:
-        return None
+    if 'X-Original-URI' in request.headers:
+        match = TOKEN_IN_URI_REGEX.search(request.headers['X-Original-URI'])
+        if match:
+            return match[1]
+
+    return None
 
-    login = login_token_record[token]
 
-    if not (time.time() - login.login_at <
-            config.get('login_life_time', 24 * 3600)):
-        del login_token_record[request.cookies['token']]
+def get_login_record(token=None):
+    if token is None:
+        token = get_token()
+    if not token:
         return None
-    return login
+
+    with tracer.phase('token_lookup'):
+        return session_store.get(token)
+
+
+def log(message):
+    with tracer.phase('logging'):
+        logger.info(message)
+
+
+def check_auth(token, privileges, remote_addr):
+    check = start_auth(token, privileges, remote_addr)
+    if isinstance(check, int):
+        return check
+
+    try:
+        with tracer.phase('privilege_check'):
+            allowed = user_table.verify_user_privileges(check.login.user, privileges)
+    except ValueError:
+        allowed = None
+    return finish_auth(check, allowed)
+
+
+# The decision of check_auth() around the privilege check, which the ASGI
+# front end makes with its own user table, see nslogin.asgi.
+def start_auth(token, privileges, remote_addr):
+    """Return the status if the decision cache or a missing session
+    settles it, else the AuthCheck to pass to finish_auth() with the
+    result of the privilege check."""
+    decision = auth_cache.get(token, privileges) if auth_cache and token else None
+    if decision:
+        return auth_status(decision.user, decision.allowed, privileges)
+
+    login = get_login_record(token) if token else None
+    if not login:
+        log(f"Unsuccessful auth request from {remote_addr}.")
+        return 401
+
+    # Read before the privilege check, see AuthCache.
+    generation = auth_cache.generation(login.user) if auth_cache else None
+    return AuthCheck(token, privileges, remote_addr, login, generation)
+
+
+def finish_auth(check, allowed):
+    """`allowed` is None if the user doesn't exist anymore."""
+    user = check.login.user
+    if allowed is None:
+        # Deleted, e.g. while holding a signed token of another replica.
+        log(f"Auth request of deleted user {user} from {check.remote_addr}.")
+        return 401
+
+    if auth_cache:
+        auth_cache.put(check.token, check.privileges, user, allowed,
+                       check.login.login_at + config.get('login_life_time', 24 * 3600),
+                       check.generation)
+    return auth_status(user, allowed, check.privileges)
+
+
+def auth_status(user, allowed, privileges):
+    if not allowed:
+        log(f"Rejected {user}'s access request to privileged area {privileges}.")
+        return 403
+
+    return 200
 
 
 @app.route('/auth', defaults={'privileges': "default"})
 @app.route('/auth/<path:privileges>')
 def auth(privileges):
-    login = get_login_record()
-    if not login:
-        logger.info(f"Unsuccessful auth request from {request.remote_addr}.")
+    status = check_auth(get_token(), privileges, request.remote_addr)
+    if status == 401:
         abort(401)
-
-    if not user_table.verify_user_privileges(login.user, privileges.split("/")):
-        logger.info(f"Rejected {login.user}'s access request to privileged area {privileges}.")
-        return render_template("403.template.html",
-                               site_name=config.get("site_name", "Restricted Area")
-                               ), 403
+    if status == 403:
+        return serve_page(pages['403'], 403)
 
     return '', 200
 
@@ -73,32 +153,15 @@ def auth(privileges):
 def login_page():
     login = get_login_record()
     if login:
-        return render_template("post-login.template.html",
-                               site_name=config.get("site_name", "Restricted Area"),
-                               post_login_title=config.get("post_login_page_title",
-                                                           "User Area"),
-                               post_login_message=config.get("post_login_message",
-                                                             "Welcome"),
+        return serve_page(pages['post-login'])
 
-                               ), 200
-    else:
-        redirect = ""
-        if 'redirect' in request.args:
-            redirect = request.args['redirect']
+    logout = 'logout' in request.args
+    redirect_to = request.args.get('redirect', "")
+    if not redirect_to:
+        return serve_page(pages['login', logout])
 
-        logout = False
-        if 'logout' in request.args:
-            logout = True
-
-        return render_template("login.template.html",
-                               site_name=config.get("site_name", "Restricted Area"),
-                               login_title=config.get("login_page_title",
-                                                      "Authentication Needed"),
-                               login_message=config.get("login_page_message",
-                                                        ""),
-                               register=safeget(config, 'register', 'enabled'),
-                               redirect=redirect,
-                               logout=logout), 200
+    body = login_templates[logout].replace(REDIRECT_PLACEHOLDER, str(escape(redirect_to)))
+    return serve_page(make_page(body))
 
 
 @app.route('/', methods=['POST'])
@@ -109,26 +172,40 @@ def verify_login():
         user = request.form['user']
         password = request.form['password']
 
-        if (user_table.has_user(user) and
-                user_table.verify_user_password(user, password)):
-            user_table.update_user_login_info(user, request.remote_addr,
-                                              int(time.time()))
-
-            logger.info(f"User {user} logged in from {request.remote_addr}.")
-
-            login_at = int(time.time())
-            token = secrets.token_hex(16)
-            login_token_record[token] = LoginTokenRecord(user, token, login_at)
+        if not allow_login(user, request.remote_addr):
+            return 'too many attempts', 429
 
+        with tracer.phase('backend'):
+            authenticated = user_table.authenticate(user, password, request.remote_addr,
+                                                    int(time.time()))
+        login = finish_login(user, request.remote_addr, authenticated)
+        if login:
             resp = make_response('', 200)
-            resp.set_cookie('token', token,
+            resp.set_cookie('token', login.token,
                             expires=time.time() + config.get('login_life_time', 24 * 3600))
             return resp
-
-        logger.info(f"Failed login attempt for {user} from {request.remote_addr}.")
     abort(403)
 
 
+# Shared with the ASGI front end, as start_auth() and finish_auth().
+def allow_login(user, remote_addr):
+    if login_rate_limit and not login_rate_limit.allow(remote_addr, user):
+        log(f"Throttled login attempt for {user} from {remote_addr}.")
+        return False
+    return True
+
+
+def finish_login(user, remote_addr, authenticated):
+    """Return the new session of `user`, or None if not `authenticated`."""
+    if not authenticated:
+        log(f"Failed login attempt for {user} from {remote_addr}.")
+        return None
+
+    log(f"User {user} logged in from {remote_addr}.")
+    with tracer.phase('sessions'):
+        return session_store.new_session(user, time.time())
+
+
 @app.route('/changepassword', methods=['POST'])
 def change_password():
     login = get_login_record()
@@ -141,10 +218,22 @@ def change_password():
         old_password = request.form['old-password']
         new_password = request.form['new-password']
 
-        if (user_table.has_user(user) and
-                user_table.verify_user_password(user, old_password)):
-            user_table.change_user_password(user, new_password)
-            return '', 200
+        with tracer.phase('backend'):
+            verified = (user_table.has_user(user) and
+                        user_table.verify_user_password(user, old_password))
+            if verified:
+                user_table.change_user_password(user, new_password)
+
+        if verified:
+            # Sign out every session of this user, then renew the current
+            # one if it is theirs.
+            session_store.remove_user(user)
+            resp = make_response('', 200)
+            if login.user.lower() == user.lower():
+                login = session_store.new_session(login.user, time.time())
+                resp.set_cookie('token', login.token,
+                                expires=login.login_at + config.get('login_life_time', 24 * 3600))
+            return resp
         abort(403)
 
 
@@ -154,10 +243,11 @@ def change_password_page():
     if not login:
         abort(401)
 
-    return render_template("change-password.template.html",
-                           site_name=config.get("site_name", "Restricted Area"),
-                           user=login.user
-                           ), 200
+    with tracer.phase('rendering'):
+        return render_template("change-password.template.html",
+                               site_name=config.get("site_name", "Restricted Area"),
+                               user=login.user
+                               ), 200
 
 
 @app.route('/register', methods=['POST'])
@@ -175,32 +265,39 @@ def register():
         if not safeget(config, 'register', 'enabled'):
             return 'disabled', 400
 
+        try:
+            check_user_name(user)
+        except ValueError:
+            return 'invalid', 400
+
         if safeget(config, 'register', 'use_invitation_code'):
-            code_file = safeget(config, 'register', 'invitation_code_file')
-            if not code_file or not os.path.exists(code_file):
-                logger.error(f'Cannot read invitation code file {code_file}')
+            if invitation_codes is None:
                 return abort(500)
 
-            with open(code_file, "r") as f:
-                codes = yaml.safe_load(f)
-
-            if not invitation or invitation not in codes:
+            if not invitation or invitation not in invitation_codes:
                 return 'invitation', 400
 
             if user_table.has_user(user):
                 return 'duplicated', 400
 
-            user_table.add_user(user, password)
+            if not invitation_codes.consume(invitation):
+                # Used by a concurrent registration.
+                return 'invitation', 400
 
-            if safeget(config, 'register', 'dispose_used_invitation_code'):
-                codes.remove(invitation)
-                with open(code_file, "w") as f:
-                    yaml.dump(codes, f)
+            try:
+                with tracer.phase('backend'):
+                    added = user_table.add_user(user, password) is not False
+            except ValueError:
+                added = False
+            if not added:
+                invitation_codes.restore(invitation)
+                return 'duplicated', 400
         else:
             if user_table.has_user(user):
                 return 'duplicated', 400
 
-            user_table.add_user(user, password)
+            with tracer.phase('backend'):
+                user_table.add_user(user, password)
 
         return '', 200
 
@@ -210,31 +307,255 @@ def register_page():
     if not safeget(config, 'register', 'enabled'):
         return redirect('./')
 
-    return render_template("register.template.html",
-                           site_name=config.get("site_name", "Restricted Area"),
-                           invitation=safeget(config, 'register', 'use_invitation_code')
-                           ), 200
+    return serve_page(pages['register'])
 
 
 @app.route('/logout', methods=['GET'])
 def logout():
     login = get_login_record()
     if login:
-        del login_token_record[login.token]
+        session_store.remove(login.token)
+        if auth_cache:
+            auth_cache.invalidate_token(login.token)
 
-    return '', 200
+    resp = make_response('', 200)
+    resp.delete_cookie('token')
+    return resp
+
+
+@app.route('/static/<path:filename>', methods=['GET'])
+def static_file(filename):
+    return static_assets.send(filename, request.accept_encodings)
+
+
+@app.template_global()
+def asset(name):
+    return static_assets.url(name)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_page():
+    if not metrics:
+        abort(404)
+    if not is_admin_request('metrics'):
+        abort(403)
+
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@app.route('/admin/profile', methods=['POST'])
+def start_profile():
+    if not profiler:
+        abort(404)
+    if not is_admin_request('profiling'):
+        abort(403)
+
+    duration = (request.values.get('seconds', type=float) or
+                safeget(config, 'profiling', 'duration') or 30)
+    path = profiler.start(duration)
+    if not path:
+        return 'already running', 409
+    return path, 202
+
+
+def is_admin_request(section):
+    return request.remote_addr in (safeget(config, section, 'allow') or ['127.0.0.1', '::1'])
+
+
+@app.before_request
+def start_request_timer():
+    if metrics:
+        g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    if metrics and 'request_start' in g:
+        record_request_metrics(request.endpoint or 'unknown', response.status_code,
+                               time.perf_counter() - g.request_start)
+    return response
+
+
+def record_request_metrics(endpoint, status, duration):
+    labels = (('endpoint', endpoint),)
+    metrics.observe('nslogin_request_duration_seconds', labels, duration)
+    metrics.inc('nslogin_requests_total', labels + (('status', str(status)),))
+
+
+def check_auth_timed(token, privileges, remote_addr):
+    # For the fast path, which bypasses Flask's request hooks.
+    start = time.perf_counter()
+    status = check_auth(token, privileges, remote_addr)
+    record_request_metrics('auth', status, time.perf_counter() - start)
+    return status
+
+
+def setup_metrics():
+    global metrics, user_table
+
+    metrics = Metrics()
+    metrics.describe('nslogin_requests_total', 'counter',
+                     'Requests handled, by endpoint and status code.')
+    metrics.describe('nslogin_request_duration_seconds', 'histogram',
+                     'Time spent handling requests, by endpoint.')
+    metrics.describe('nslogin_user_table_call_duration_seconds', 'histogram',
+                     'Time spent in user table calls, by method.')
+
+    def count_sessions():
+        count = session_store.count()
+        # Signed sessions are not stored, hence not counted.
+        return [((), count)] if count is not None else []
+
+    metrics.add_gauge('nslogin_sessions', 'Active login sessions.', count_sessions)
+
+    if hasattr(user_table, 'pool_stats'):
+        def pool_connections():
+            stats = user_table.pool_stats()
+            return [((('state', 'in_use'),), stats['in_use']),
+                    ((('state', 'idle'),), stats['idle'])]
+
+        metrics.add_gauge('nslogin_db_pool_connections',
+                          'Database connections, by state.', pool_connections)
+
+    user_table = TimedUserTable(user_table, metrics)
+
+
+def setup_profiling():
+    global profiler
+
+    profiling = config.get('profiling') or {}
+    profiler = SamplingProfiler(interval=profiling.get('interval', 0.005),
+                                output_dir=profiling.get('output_dir'))
+    if profiling.get('signal', True):
+        duration = profiling.get('duration', 30)
+        try:
+            signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.start(duration))
+        except ValueError:
+            logger.warning("SIGUSR2 can only be handled when set up from the main thread.")
+
+    threshold = profiling.get('slow_request_threshold')
+    if threshold is None:
+        return
+
+    # Log where slow requests spend their time, see RequestTracing.
+    tracer.threshold = threshold
 
 
 @app.route('/403', methods=['GET'])
 def forbidden():
-    return render_template("403.template.html",
-                           site_name=config.get("site_name", "Restricted Area")
-                           ), 403
+    return serve_page(pages['403'], 403)
+
+
+def make_page(body):
+    return Page(body, generate_etag(body.encode('utf-8')))
+
+
+def serve_page(page, status=200):
+    with tracer.phase('rendering'):
+        resp = make_response(page.body, status)
+        resp.set_etag(page.etag)
+        # Browsers may keep the page, but must ask whether it is still
+        # current, which the login state (the cookie) is part of.
+        resp.headers['Cache-Control'] = 'no-cache'
+        resp.vary.add('Cookie')
+        if status == 200:
+            resp.make_conditional(request)
+        return resp
+
+
+def render_pages():
+    """Render the pages that only depend on the configuration. The login
+    page is rendered for both values of `logout`, with a placeholder for
+    the redirect target."""
+    site_name = config.get("site_name", "Restricted Area")
+
+    pages['403'] = make_page(render_template("403.template.html", site_name=site_name))
+    pages['post-login'] = make_page(render_template(
+        "post-login.template.html",
+        site_name=site_name,
+        post_login_title=config.get("post_login_page_title", "User Area"),
+        post_login_message=config.get("post_login_message", "Welcome")))
+    pages['register'] = make_page(render_template(
+        "register.template.html",
+        site_name=site_name,
+        invitation=safeget(config, 'register', 'use_invitation_code')))
+
+    for logout in (False, True):
+        login_templates[logout] = render_template(
+            "login.template.html",
+            site_name=site_name,
+            login_title=config.get("login_page_title", "Authentication Needed"),
+            login_message=config.get("login_page_message", ""),
+            register=safeget(config, 'register', 'enabled'),
+            redirect=REDIRECT_PLACEHOLDER,
+            logout=logout)
+        pages['login', logout] = make_page(
+            login_templates[logout].replace(REDIRECT_PLACEHOLDER, ""))
+
+
+def setup(config_):
+    global user_table, session_store, config, auth_cache, login_rate_limit, \
+        invitation_codes, static_assets, forbidden_page
+
+    config = config_
 
+    user_table = get_user_table(config)
+    atexit.register(user_table.close)
+    session_store = get_session_store(config, user_table)
+    session_store.start_sweeper(safeget(config, 'session', 'sweep_interval') or 60)
+
+    if safeget(config, 'auth_cache', 'enabled') is not False:
+        auth_cache = AuthCache(
+            max_size=safeget(config, 'auth_cache', 'max_size') or 10000,
+            ttl=safeget(config, 'auth_cache', 'ttl') or 10)
+        user_table.add_change_listener(auth_cache.invalidate_user)
+
+    if safeget(config, 'metrics', 'enabled'):
+        setup_metrics()
+
+    if safeget(config, 'profiling', 'enabled'):
+        setup_profiling()
+
+    if safeget(config, 'login_rate_limit', 'enabled') is not False:
+        login_rate_limit = LoginRateLimit.from_config(config.get('login_rate_limit'))
+
+    code_file = safeget(config, 'register', 'invitation_code_file')
+    if (safeget(config, 'register', 'enabled') and
+            safeget(config, 'register', 'use_invitation_code')):
+        if code_file and os.path.exists(code_file):
+            invitation_codes = InvitationCodeStore(
+                code_file,
+                dispose_used=bool(safeget(config, 'register', 'dispose_used_invitation_code')),
+                flush_interval=safeget(config, 'register', 'invitation_code_flush_interval') or 5)
+            invitation_codes.watch()
+            atexit.register(invitation_codes.close)
+        else:
+            logger.error(f'Cannot read invitation code file {code_file}')
 
-def main():
-    global user_table, app, config, logger
+    def drop_sessions_of_deleted_user(user):
+        if not user_table.has_user(user):
+            session_store.remove_user(user)
 
+    user_table.add_change_listener(drop_sessions_of_deleted_user)
+    if safeget(config, 'yaml', 'watch'):
+        user_table.watch_for_changes(safeget(config, 'yaml', 'watch_interval') or 2)
+
+    static_assets = StaticAssets(os.path.join(app.root_path, 'static'))
+    with app.app_context():
+        render_pages()
+    forbidden_page = pages['403'].body
+
+    app.wsgi_app = ReverseProxied(app.wsgi_app)
+    if config.get('auth_fast_path', True):
+        # Answer /auth before Flask's routing and request handling.
+        app.wsgi_app = AuthFastPath(app.wsgi_app,
+                                    check_auth_timed if metrics else check_auth,
+                                    forbidden_page)
+    if tracer.threshold is not None:
+        app.wsgi_app = RequestTracing(app.wsgi_app, tracer)
+
+
+def main():
     parser = argparse.ArgumentParser(
         description="a web service that provides authentication together with "
                     "Nginx's auth_request module")
@@ -251,16 +572,14 @@ def main():
             exit(1)
 
     with open(args.config_path, "r") as f:
-        config = yaml.safe_load(f)
+        config_ = yaml.safe_load(f)
 
     logger.setLevel(logging.INFO)
-    if 'logfile' in config and config['logfile']:
-        handler = logging.FileHandler(config['logfile'])
+    if 'logfile' in config_ and config_['logfile']:
+        handler = logging.FileHandler(config_['logfile'])
     else:
         handler = logging.StreamHandler()
 
-    user_table = get_user_table(config)
-
     formatter = logging.Formatter(
         '[%(asctime)s %(levelname)s] %(message)s', "%b %d %H:%M:%S")
     handler.setFormatter(formatter)
@@ -269,11 +588,20 @@ def main():
     werkzeug_logger = logging.getLogger('werkzeug')
     werkzeug_logger.setLevel(logging.WARNING)
 
-    app.wsgi_app = ReverseProxied(app.wsgi_app)
+    if safeget(config_, 'server', 'mode') == 'prefork':
+        run_prefork(app, setup, config_)
+        return
+    if safeget(config_, 'server', 'mode') == 'asgi':
+        run_asgi(app, setup, sys.modules[__name__], config_)
+        return
 
-    app.run(port=config.get('port', 8222), host=config.get('host', '127.0.0.1'))
+    setup(config_)
+
+    # Exit through SystemExit so that atexit handlers flush pending writes.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    run_development(app, config)
 
 
 if __name__ == "__main__":
     main()
-
@@ -1,6 +1,10 @@
 import os
 import re
+import sys
+import csv
+import json
 import argparse
+import contextlib
 import yaml
 
 from nslogin.storage import get_user_table, UserTable
@@ -138,6 +142,154 @@ def list_user(args):
         print(f"{len(user_info_list)} users in total")
 
 
+EXPORT_FIELDS = ['name', 'password_hash', 'password_salt', 'privileges',
+                 'last_login_timestamp', 'last_login_ip']
+
+
+def get_file_format(args, path):
+    if args.file_format:
+        return args.file_format
+    if path.endswith('.csv'):
+        return 'csv'
+    if path.endswith('.jsonl'):
+        return 'jsonl'
+
+    print("ERROR: cannot tell the file format from its name, use --format.")
+    exit(1)
+
+
+def open_user_file(path, mode):
+    # '-' stands for stdin / stdout.
+    if path == '-':
+        return contextlib.nullcontext(sys.stdin if mode == 'r' else sys.stdout)
+    if mode == 'w':
+        # The file holds password hashes.
+        return open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600),
+                    'w', newline='')
+    return open(path, mode, newline='')
+
+
+def read_user_records(f, file_format):
+    """Yield (line number, record) for each user of the file. A record that
+    can't be parsed is None."""
+    if file_format == 'csv':
+        reader = csv.DictReader(f)
+        for record in reader:
+            yield reader.line_num, record
+        return
+
+    for line_num, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_num, json.loads(line)
+        except ValueError:
+            yield line_num, None
+
+
+def parse_user_record(record):
+    """Return (user, password, password_hash, password_salt, privileges),
+    raise ValueError if the record is invalid."""
+    if not isinstance(record, dict):
+        raise ValueError("not a valid record")
+
+    user = str(record.get('name') or "").strip()
+    if not re.fullmatch(r"[a-zA-Z]\w*", user):
+        raise ValueError(f"invalid user name '{user}'")
+
+    password = record.get('password') or ""
+    password_hash = record.get('password_hash') or ""
+    if bool(password) == bool(password_hash):
+        raise ValueError("either password or password_hash must be given")
+    if not isinstance(password, str) or not isinstance(password_hash, str):
+        raise ValueError("password and password_hash must be strings")
+
+    privileges = record.get('privileges') or []
+    if isinstance(privileges, str):
+        privileges = privileges.split(",")
+    # Lowercased, as by change_user_privileges().
+    privileges = [str(s).strip().lower() for s in privileges if str(s).strip()] or ['default']
+
+    return user, password, password_hash, record.get('password_salt') or "", privileges
+
+
+def import_users(args):
+    path = args.import_path
+    file_format = get_file_format(args, path)
+
+    existing = {user_info.name.lower() for user_info in user_table.list_users() or []}
+    records = []
+    errors = 0
+
+    with open_user_file(path, 'r') as f:
+        for line_num, record in read_user_records(f, file_format):
+            try:
+                user, password, hash_, salt, privileges = parse_user_record(record)
+                if user.lower() in existing:
+                    raise ValueError(f"user {user} exists")
+            except ValueError as e:
+                print(f"ERROR: line {line_num}: {e}.")
+                errors += 1
+                continue
+
+            existing.add(user.lower())
+            records.append((user, password, hash_, salt, privileges))
+
+    if errors:
+        print(f"ERROR: {errors} invalid records, no user has been imported.")
+        exit(1)
+
+    hasher = user_table.password_hasher
+    if hasher.workers:
+        hasher.workers = max(hasher.workers, os.cpu_count() or 1)
+    hashes = iter(user_table.hash_passwords(
+        [password for _, password, _, _, _ in records if password]))
+
+    users = []
+    for user, password, hash_, salt, privileges in records:
+        if password:
+            hash_, salt = next(hashes), ""
+        users.append((user, hash_, salt, privileges))
+
+    try:
+        user_table.add_users(users)
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        exit(1)
+
+    print(f"{len(users)} users have been imported.")
+
+
+def export_users(args):
+    path = args.export_path
+    file_format = get_file_format(args, path)
+
+    count = 0
+    with open_user_file(path, 'w') as f:
+        if file_format == 'csv':
+            writer = csv.DictWriter(f, EXPORT_FIELDS)
+            writer.writeheader()
+
+        for user_info in user_table.list_users() or []:
+            record = {
+                'name': user_info.name,
+                'password_hash': user_info.password_hash,
+                'password_salt': user_info.password_salt or "",
+                'privileges': list(user_info.privilege),
+                'last_login_timestamp': user_info.last_login_timestamp,
+                'last_login_ip': user_info.last_login_ip or "",
+            }
+            if file_format == 'csv':
+                record['privileges'] = ",".join(record['privileges'])
+                writer.writerow(record)
+            else:
+                f.write(json.dumps(record) + "\n")
+            count += 1
+
+    if path != '-':
+        print(f"{count} users have been exported to {path}.")
+
+
 def main():
     global user_table, config
 
@@ -157,6 +309,12 @@ def main():
                               help="list user's info")
     action_group.add_argument("--modify", "-m", action="store_true",
                               help="modify user's password and privileges")
+    action_group.add_argument("--import", dest="import_path", metavar="FILE",
+                              help="add the users of a CSV or JSONL file ('-' for "
+                                   "stdin) in one batch")
+    action_group.add_argument("--export", dest="export_path", metavar="FILE",
+                              help="write all users, with their password hashes, "
+                                   "to a CSV or JSONL file ('-' for stdout)")
 
     parser.add_argument("--name", "-n", dest="user_name",
                         help="specify the user name (for 'list' actions, wildcard "
@@ -175,6 +333,9 @@ def main():
     parser.add_argument("--privileges--revoke", "-prr", dest="privileges_remove",
                         help="revoke privileges, separated by ',' (for "
                              "action 'modify')")
+    parser.add_argument("--format", dest="file_format", choices=['csv', 'jsonl'],
+                        help="format of the file to import or export (by default, "
+                             "told from its extension)")
 
     args = parser.parse_args()
 
@@ -198,6 +359,12 @@ def main():
         modify_user(args)
     elif args.list:
         list_user(args)
+    elif args.import_path:
+        import_users(args)
+    elif args.export_path:
+        export_users(args)
+
+    user_table.close()
 
 
 if __name__ == "__main__":
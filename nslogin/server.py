@@ -0,0 +1,165 @@
+import os
+import sys
+import signal
+import socket
+import logging
+
+from nslogin.utils.misc import safeget
+
+logger = logging.getLogger('login')
+
+
+def get_unix_socket_config(config):
+    path = safeget(config, 'unix_socket', 'path')
+    if not path:
+        return None
+
+    mode = safeget(config, 'unix_socket', 'mode') or 0o660
+    if isinstance(mode, str):
+        mode = int(mode, 8)
+    backlog = safeget(config, 'unix_socket', 'backlog') or 1024
+    return path, mode, backlog
+
+
+def run_development(app, config):
+    unix_socket = get_unix_socket_config(config)
+    if not unix_socket:
+        app.run(port=config.get('port', 8222), host=config.get('host', '127.0.0.1'))
+        return
+
+    from werkzeug.serving import make_server
+
+    path, mode, backlog = unix_socket
+    server = make_server(f"unix://{path}", 0, app, threaded=True)
+    os.chmod(path, mode)
+    server.socket.listen(backlog)
+
+    logger.info(f"Listening on unix:{path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def run_prefork(app, setup, config):
+    """Serve `app` with gunicorn: `workers` processes accepting on a shared
+    socket (or each on its own with SO_REUSEPORT), each handling
+    connections in `threads` threads with HTTP/1.1 keep-alive.
+
+    `setup(config)` is called in every worker after fork, so that each one
+    has its own storage connections and background threads.
+
+    SIGHUP restarts the workers gracefully, and workers are recycled after
+    `max_requests` requests.
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise RuntimeError("server.mode 'prefork' requires the gunicorn package.")
+
+    server_config = config.get('server') or {}
+    workers = server_config.get('workers', 1)
+
+    if workers > 1:
+        # A login made through one worker would be unknown to the others.
+        if safeget(config, 'session', 'backend') in (None, 'memory'):
+            raise RuntimeError("Sessions kept in memory are not shared between workers, "
+                               "use session.backend 'sqlite' or 'signed', or a single "
+                               "worker.")
+        if config.get('db_backend', 'yaml') == 'yaml':
+            logger.warning("Every worker writes the YAML user table, e.g. on each login. "
+                           "Use the MySQL backend for several workers, or a single one.")
+
+    unix_socket = get_unix_socket_config(config)
+    if unix_socket:
+        path, mode, backlog = unix_socket
+        bind = [f"unix:{path}"]
+        server_config = dict(server_config, backlog=backlog)
+    else:
+        bind = [f"{config.get('host', '127.0.0.1')}:{config.get('port', 8222)}"]
+
+    options = {
+        'bind': bind,
+        'workers': workers,
+        'worker_class': 'gthread',
+        'threads': server_config.get('threads', 8),
+        'keepalive': server_config.get('keepalive', 75),
+        'reuse_port': server_config.get('reuse_port', False),
+        'max_requests': server_config.get('max_requests', 0),
+        'max_requests_jitter': server_config.get('max_requests_jitter', 0),
+        'graceful_timeout': server_config.get('graceful_timeout', 30),
+        'timeout': server_config.get('timeout', 30),
+        'backlog': server_config.get('backlog', 2048),
+        'proc_name': 'nslogind',
+    }
+
+    class NsloginApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            setup(config)
+            return app
+
+    if unix_socket:
+        # gunicorn creates the socket under its umask
+        options['umask'] = 0o777 & ~mode
+
+    NsloginApplication().run()
+
+
+def run_asgi(app, setup, state, config):
+    """Serve with uvicorn on a single event loop: /auth and the login form
+    are answered by AsgiAuthApp over the asyncio user table, the other
+    pages by `app` in a worker thread.
+
+    `state` is the module `setup` initializes, see AsgiAuthApp.
+    """
+    try:
+        import uvicorn
+    except ImportError:
+        raise RuntimeError("server.mode 'asgi' requires the uvicorn and asgiref packages.")
+
+    from nslogin.asgi import AsgiAuthApp
+    from nslogin.storage import get_async_user_table
+
+    setup(config)
+    asgi_app = AsgiAuthApp(app, state, get_async_user_table(config))
+
+    # uvicorn re-raises SIGTERM once it has shut down; exit through
+    # SystemExit so that the socket is removed and atexit handlers run.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    server_config = config.get('server') or {}
+    options = {
+        'lifespan': 'on',
+        'log_level': 'warning',
+        'timeout_keep_alive': server_config.get('keepalive', 75),
+        'backlog': server_config.get('backlog', 2048),
+    }
+
+    unix_socket = get_unix_socket_config(config)
+    if not unix_socket:
+        uvicorn.run(asgi_app, host=config.get('host', '127.0.0.1'),
+                    port=config.get('port', 8222), **options)
+        return
+
+    # Bind the socket ourselves to apply its mode, as in run_development().
+    path, mode, backlog = unix_socket
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    os.chmod(path, mode)
+    sock.listen(backlog)
+
+    logger.info(f"Listening on unix:{path}")
+    try:
+        uvicorn.run(asgi_app, fd=sock.fileno(), **dict(options, backlog=backlog))
+    finally:
+        sock.close()
+        if os.path.exists(path):
+            os.unlink(path)
@@ -0,0 +1 @@
+from .session_store import get_session_store, SessionStore, LoginTokenRecord
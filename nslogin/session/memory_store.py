@@ -0,0 +1,81 @@
+import time
+import heapq
+import threading
+
+from nslogin.session.session_store import SessionStore
+
+
+class MemorySessionStore(SessionStore):
+    """In-process session table holding at most `max_size` sessions.
+
+    Sessions are also ordered in a heap by login time, which lets the
+    sweeper drop expired ones without scanning the table and decides
+    which session gets evicted (the oldest one) when the table is full.
+    """
+
+    def __init__(self, life_time, max_size=100000):
+        super().__init__(life_time)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.records = {}
+        self.user_tokens = {}
+        self.heap = []  # (login_at, token), may hold removed tokens
+
+    def add(self, record):
+        with self.lock:
+            self._remove(record.token)
+            while len(self.records) >= self.max_size:
+                self._pop_oldest()
+
+            self.records[record.token] = record
+            self.user_tokens.setdefault(record.user.lower(), set()).add(record.token)
+            heapq.heappush(self.heap, (record.login_at, record.token))
+
+    def get(self, token):
+        record = self.records.get(token)
+        if record and self.is_expired(record):
+            self.remove(token)
+            return None
+        return record
+
+    def remove(self, token):
+        with self.lock:
+            self._remove(token)
+
+    def remove_user(self, user):
+        with self.lock:
+            for token in list(self.user_tokens.get(user.lower(), ())):
+                self._remove(token)
+
+    def sweep(self):
+        now = time.time()
+        with self.lock:
+            while self.heap and now - self.heap[0][0] >= self.life_time:
+                self._pop_oldest()
+
+            # Drop the heap entries of logged out sessions once they
+            # outnumber the live ones.
+            if len(self.heap) > 2 * len(self.records) + 64:
+                self.heap = [(record.login_at, token)
+                             for token, record in self.records.items()]
+                heapq.heapify(self.heap)
+
+    def count(self):
+        return len(self.records)
+
+    def _pop_oldest(self):
+        login_at, token = heapq.heappop(self.heap)
+        record = self.records.get(token)
+        if record and record.login_at == login_at:
+            self._remove(token)
+
+    def _remove(self, token):
+        record = self.records.pop(token, None)
+        if not record:
+            return
+
+        user = record.user.lower()
+        tokens = self.user_tokens[user]
+        tokens.discard(token)
+        if not tokens:
+            del self.user_tokens[user]
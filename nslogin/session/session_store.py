@@ -0,0 +1,83 @@
+import time
+import secrets
+import logging
+import threading
+from abc import ABC
+from collections import namedtuple
+
+LoginTokenRecord = namedtuple('LoginTokenRecord', ['user', 'token', 'login_at'])
+
+logger = logging.getLogger('login')
+
+
+def get_session_store(config, user_table=None):
+    session_config = config.get('session') or {}
+    backend = session_config.get('backend', 'memory')
+    life_time = config.get('login_life_time', 24 * 3600)
+
+    if backend == 'memory':
+        from .memory_store import MemorySessionStore
+        return MemorySessionStore(life_time, session_config.get('max_size', 100000))
+    elif backend == 'sqlite':
+        from .sqlite_store import SqliteSessionStore
+        return SqliteSessionStore(session_config.get('path', 'sessions.sqlite'),
+                                  life_time)
+    elif backend == 'signed':
+        from .signed_store import SignedSessionStore
+        secret = session_config.get('secret')
+        if not secret:
+            logger.warning("No session.secret configured, a random one is used. "
+                           "Tokens won't survive restarts or work across replicas.")
+            secret = secrets.token_bytes(32)
+        return SignedSessionStore(secret, life_time)
+
+    raise ValueError(f'Unsupported session backend: {backend}')
+
+
+class SessionStore(ABC):
+    def __init__(self, life_time):
+        self.life_time = life_time
+        self.sweeper = None
+
+    @staticmethod
+    def generate_token():
+        return secrets.token_hex(16)
+
+    def new_session(self, user, login_at):
+        record = LoginTokenRecord(user, self.generate_token(), login_at)
+        self.add(record)
+        return record
+
+    def is_expired(self, record, now=None):
+        return (now or time.time()) - record.login_at >= self.life_time
+
+    def start_sweeper(self, interval=60):
+        def sweep_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.sweep()
+                except Exception:
+                    logger.exception("Failed to sweep expired sessions.")
+
+        self.sweeper = threading.Thread(target=sweep_loop, name="session-sweeper",
+                                        daemon=True)
+        self.sweeper.start()
+
+    def add(self, record):
+        raise NotImplementedError
+
+    def get(self, token):
+        raise NotImplementedError
+
+    def remove(self, token):
+        raise NotImplementedError
+
+    def remove_user(self, user):
+        raise NotImplementedError
+
+    def sweep(self):
+        raise NotImplementedError
+
+    def count(self):
+        raise NotImplementedError
@@ -0,0 +1,65 @@
+import os
+import time
+import sqlite3
+import threading
+
+from nslogin.session.session_store import SessionStore, LoginTokenRecord
+
+
+class SqliteSessionStore(SessionStore):
+    """Sessions kept in an SQLite database in WAL mode, so that every
+    nslogind process on the host sees the same set of tokens."""
+
+    def __init__(self, path, life_time):
+        super().__init__(life_time)
+        self.path = path
+        self.local = threading.local()
+        conn = self.connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "token TEXT PRIMARY KEY, user TEXT NOT NULL COLLATE NOCASE, "
+            "login_at INTEGER NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_user ON sessions (user)")
+        conn.execute("CREATE INDEX IF NOT EXISTS sessions_login_at ON sessions (login_at)")
+
+    def connection(self):
+        # Connections are per thread, and must not be inherited across fork().
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def get(self, token):
+        row = self.connection().execute(
+            "SELECT user, token, login_at FROM sessions WHERE token=?",
+            (token,)).fetchone()
+        if not row:
+            return None
+
+        record = LoginTokenRecord(*row)
+        if self.is_expired(record):
+            self.remove(token)
+            return None
+        return record
+
+    def add(self, record):
+        self.connection().execute(
+            "INSERT OR REPLACE INTO sessions (token, user, login_at) VALUES (?, ?, ?)",
+            (record.token, record.user, record.login_at))
+
+    def remove(self, token):
+        self.connection().execute("DELETE FROM sessions WHERE token=?", (token,))
+
+    def remove_user(self, user):
+        self.connection().execute("DELETE FROM sessions WHERE user=?", (user,))
+
+    def sweep(self):
+        self.connection().execute("DELETE FROM sessions WHERE login_at <= ?",
+                                  (time.time() - self.life_time,))
+
+    def count(self):
+        return self.connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
@@ -1,2 +1,3 @@
-from .storage import get_user_table
-from .user_table import UserTable
\ No newline at end of file
+from .storage import get_user_table, get_async_user_table
+from .user_table import UserTable, check_user_name
+from .async_user_table import AsyncUserTable
@@ -0,0 +1,155 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+
+from nslogin.storage.connection_pool import PoolTimeout
+
+logger = logging.getLogger('login')
+
+
+class AsyncConnectionPool:
+    """asyncio counterpart of ConnectionPool, for drivers whose connect()
+    and health check are coroutines.
+
+    :param connect: coroutine function returning a new connection
+    :param health_check: coroutine function raising if a connection is
+        broken, awaited on checkout of a connection idle for at least
+        `health_check_after` seconds
+    :param connection_errors: exceptions after which a connection is
+        health-checked before going back to the pool
+    """
+
+    def __init__(self, connect, min_size=1, max_size=10, idle_timeout=300,
+                 checkout_timeout=10, health_check=None, health_check_after=0,
+                 connection_errors=(Exception,)):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.health_check = health_check
+        self.health_check_after = health_check_after
+        self.connection_errors = connection_errors
+
+        self.condition = asyncio.Condition()
+        self.idle = deque()  # (connection, returned_at)
+        self.size = 0
+        self.in_use = 0
+
+        self.checkouts = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.failures = 0
+
+    @asynccontextmanager
+    async def connection(self):
+        conn = await self.acquire()
+        try:
+            yield conn
+        except self.connection_errors:
+            await self.release(conn, broken=not await self.is_alive(conn))
+            raise
+        except Exception:
+            await self.release(conn)
+            raise
+        else:
+            await self.release(conn)
+
+    async def acquire(self):
+        start = time.monotonic()
+
+        async with self.condition:
+            self._close_expired()
+            try:
+                await asyncio.wait_for(
+                    self.condition.wait_for(
+                        lambda: self.idle or self.size < self.max_size),
+                    self.checkout_timeout)
+            except asyncio.TimeoutError:
+                raise PoolTimeout(f"No free connection in {self.checkout_timeout}s.")
+
+            if self.idle:
+                conn, returned_at = self.idle.pop()
+            else:
+                self.size += 1
+                conn = None
+            self.in_use += 1
+
+        try:
+            if (conn is not None and
+                    time.monotonic() - returned_at >= self.health_check_after and
+                    not await self.is_alive(conn)):
+                logger.warning("Pool: discarding broken connection.")
+                self._close(conn)
+                conn = None
+            if conn is None:
+                conn = await self.connect()
+        except Exception:
+            async with self.condition:
+                self.size -= 1
+                self.in_use -= 1
+                self.failures += 1
+                self.condition.notify()
+            raise
+
+        wait = time.monotonic() - start
+        self.checkouts += 1
+        self.total_wait_time += wait
+        self.max_wait_time = max(self.max_wait_time, wait)
+
+        return conn
+
+    async def release(self, conn, broken=False):
+        async with self.condition:
+            self.in_use -= 1
+            if broken:
+                self.size -= 1
+                self.failures += 1
+                self._close(conn)
+            else:
+                self.idle.append((conn, time.monotonic()))
+            self.condition.notify()
+
+    async def is_alive(self, conn):
+        if not self.health_check:
+            return True
+        try:
+            await self.health_check(conn)
+            return True
+        except Exception:
+            return False
+
+    async def close(self):
+        async with self.condition:
+            while self.idle:
+                conn, _ = self.idle.popleft()
+                self.size -= 1
+                self._close(conn)
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'in_use': self.in_use,
+            'idle': len(self.idle),
+            'checkouts': self.checkouts,
+            'avg_wait_time': self.total_wait_time / self.checkouts if self.checkouts else 0.0,
+            'max_wait_time': self.max_wait_time,
+            'failures': self.failures,
+        }
+
+    def _close_expired(self):
+        now = time.monotonic()
+        while (self.idle and self.size > self.min_size and
+               now - self.idle[0][1] > self.idle_timeout):
+            conn, _ = self.idle.popleft()
+            self.size -= 1
+            self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
@@ -0,0 +1,94 @@
+import asyncio
+from abc import ABC
+
+from nslogin.storage.privileges import PrivilegeIndex
+from nslogin.utils.password_hasher import PasswordHasher, is_kdf_hash
+
+
+class AsyncUserTable(ABC):
+    """Coroutine counterpart of UserTable, for backends whose storage is
+    reached through an asyncio driver. Change listeners are plain
+    callables, as for UserTable."""
+
+    def __init__(self):
+        self.change_listeners = []
+        self.privilege_index = PrivilegeIndex()
+        self.password_hasher = PasswordHasher()
+
+    def add_change_listener(self, listener):
+        self.change_listeners.append(listener)
+
+    def notify_user_changed(self, user):
+        for listener in self.change_listeners:
+            listener(user.lower())
+
+    async def close(self):
+        pass
+
+    async def has_user(self, user):
+        raise NotImplementedError
+
+    async def add_user(self, user, password, privilege=None):
+        raise NotImplementedError
+
+    async def delete_user(self, user):
+        raise NotImplementedError
+
+    async def list_users(self, name="", regex=""):
+        raise NotImplementedError
+
+    async def change_user_password(self, user, new_password):
+        raise NotImplementedError
+
+    async def verify_user_password(self, user, password_provided):
+        raise NotImplementedError
+
+    async def update_user_login_info(self, user, ip, timestamp):
+        raise NotImplementedError
+
+    async def hash_password(self, password):
+        return await asyncio.wrap_future(self.password_hasher.hash_future(password))
+
+    async def check_password(self, user_info, password):
+        if is_kdf_hash(user_info.password_hash):
+            return await asyncio.wrap_future(
+                self.password_hasher.verify_future(password, user_info.password_hash))
+        return self.verify_legacy_hash(user_info, password)
+
+    def verify_legacy_hash(self, user_info, password):
+        raise NotImplementedError
+
+    async def authenticate(self, user, password, ip, timestamp):
+        # See UserTable.authenticate().
+        if not await self.has_user(user):
+            return False
+
+        user_info = (await self.list_users(name=user))[0]
+        if not await self.check_password(user_info, password):
+            return False
+
+        if self.password_hasher.needs_rehash(user_info.password_hash):
+            await self.change_user_password(user, password)
+        await self.update_user_login_info(user, ip, timestamp)
+        return True
+
+    async def verify_user_privileges(self, user, privileges):
+        user_mask = await self.get_user_privilege_mask(user)
+        if not isinstance(privileges, str):
+            privileges = tuple(privileges)
+        return self.privilege_index.compile(privileges)(user_mask)
+
+    async def get_user_privilege_mask(self, user):
+        raise NotImplementedError
+
+    async def get_user_privileges(self, user):
+        raise NotImplementedError
+
+    async def change_user_privileges(self, user, privileges):
+        raise NotImplementedError
+
+    async def add_user_privileges(self, user, privileges):
+        raise NotImplementedError
+
+    async def remove_user_privileges(self, user, privileges):
+        raise NotImplementedError
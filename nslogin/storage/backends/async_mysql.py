@@ -0,0 +1,290 @@
+import hmac
+import logging
+
+from nslogin.storage.async_pool import AsyncConnectionPool
+from nslogin.storage.async_user_table import AsyncUserTable
+from nslogin.storage.backends.mysql_common import (USER_COLUMNS, get_salted_hash,
+                                                   pack_user_info)
+from nslogin.storage.user_table import check_user_name
+from nslogin.utils.misc import get, safeget
+
+logger = logging.getLogger('login')
+
+
+def get_async_user_table(config, connect=None):
+    try:
+        host = get(config, 'mysql', 'host')
+        port = get(config, 'mysql', 'port')
+        user = get(config, 'mysql', 'user')
+        password = get(config, 'mysql', 'password')
+        database = get(config, 'mysql', 'database')
+        table = get(config, 'mysql', 'table')
+        pool_config = safeget(config, 'mysql', 'pool') or {}
+
+        return AsyncMysqlUserTable(user, password, database, table, host, port,
+                                   pool_config, connect)
+
+    except KeyError:
+        raise KeyError("Invalid MySQL configuration!")
+
+
+class AsyncMysqlUserTable(AsyncUserTable):
+    """The MySQL user table over aiomysql, so that a request waiting for
+    the database doesn't hold a thread.
+
+    :param connect: coroutine function taking the access keyword arguments
+        (user, password, db, host, port, autocommit) and returning a
+        connection with aiomysql's interface; defaults to aiomysql.connect.
+        Queries use the `%s` paramstyle, and the row count of an UPDATE
+        must be the number of rows matched (aiomysql is connected with
+        CLIENT.FOUND_ROWS for this).
+    """
+
+    def __init__(self, user, password, database, table, host, port,
+                 pool_config=None, connect=None):
+        super().__init__()
+        self.user_db_access = {
+            'user': user,
+            'password': password,
+            'db': database,
+            'host': host,
+            'port': port,
+            'autocommit': True
+        }
+        self.table = table
+
+        if connect is None:
+            try:
+                import aiomysql
+            except ImportError:
+                raise RuntimeError("The asyncio MySQL backend requires the aiomysql package.")
+            from pymysql.constants import CLIENT
+            connect = aiomysql.connect
+            self.user_db_access['client_flag'] = CLIENT.FOUND_ROWS
+            self.retry_errors = (aiomysql.InterfaceError, aiomysql.OperationalError)
+        else:
+            self.retry_errors = (ConnectionError,)
+        self.driver_connect = connect
+
+        pool_config = pool_config or {}
+        self.pool = AsyncConnectionPool(
+            self.connect,
+            min_size=pool_config.get('min_size', 1),
+            max_size=pool_config.get('max_size', 10),
+            idle_timeout=pool_config.get('idle_timeout', 300),
+            checkout_timeout=pool_config.get('checkout_timeout', 10),
+            health_check_after=pool_config.get('health_check_after', 5),
+            health_check=lambda conn: conn.ping(False),
+            connection_errors=self.retry_errors
+        )
+
+    async def connect(self):
+        return await self.driver_connect(**self.user_db_access)
+
+    async def run(self, func):
+        # Same single retry on a fresh connection as MysqlUserTable.run().
+        try:
+            async with self.pool.connection() as conn:
+                return await func(conn)
+        except self.retry_errors as e:
+            logger.warning(f"Mysql: connection failed ({e}), reconnecting.")
+            async with self.pool.connection() as conn:
+                return await func(conn)
+
+    def pool_stats(self):
+        return self.pool.stats()
+
+    async def close(self):
+        await self.pool.close()
+
+    async def query(self, sql_template, filler=()):
+        async def _query(conn):
+            async with conn.cursor() as cursor:
+                await cursor.execute(sql_template, filler or None)
+                return await cursor.fetchall()
+
+        return await self.run(_query)
+
+    async def execute(self, sql_template, filler=()):
+        # Returns the affected row count.
+        async def _execute(conn):
+            async with conn.cursor() as cursor:
+                await cursor.execute(sql_template, filler or None)
+                return cursor.rowcount
+
+        return await self.run(_execute)
+
+    async def transaction(self, func):
+        """Run `await func(cursor)` inside a transaction, which is rolled
+        back if it raises."""
+        async def _transaction(conn):
+            await conn.begin()
+            try:
+                async with conn.cursor() as cursor:
+                    result = await func(cursor)
+                await conn.commit()
+                return result
+            except Exception:
+                await conn.rollback()
+                raise
+
+        return await self.run(_transaction)
+
+    async def query_user(self, user):
+        ret = await self.query(f"SELECT {USER_COLUMNS} FROM `{self.table}` "
+                               "WHERE username=%s", (user.lower(),))
+        if not ret:
+            return None
+
+        return pack_user_info(ret[0])
+
+    async def has_user(self, user):
+        return bool(await self.query(f"SELECT id FROM `{self.table}` WHERE username=%s",
+                                     (user.lower(),)))
+
+    async def add_user(self, user, password, privilege=None):
+        check_user_name(user)
+        hash_ = await self.hash_password(password)
+
+        if not privilege:
+            privilege = ['default']
+
+        # The unique key on username rejects an existing user; the driver's
+        # error class is not known here, so only then is the user looked up.
+        try:
+            await self.execute(f"INSERT INTO `{self.table}` "
+                               "(username, realname, password, salt, web_privileges) "
+                               "VALUES (%s, %s, %s, NULL, %s)",
+                               (user.lower(), user, hash_, ",".join(privilege)))
+        except Exception:
+            if await self.has_user(user):
+                return False
+            raise
+
+        return True
+
+    async def delete_user(self, user):
+        user = user.lower()
+        if not await self.execute(f"DELETE FROM `{self.table}` WHERE username=%s", (user,)):
+            raise ValueError(f"User '{user}' doesn't exist.")
+        self.notify_user_changed(user)
+
+    async def list_users(self, name="", regex=""):
+        name = name.lower()
+        if name:
+            user_info = await self.query_user(name)
+            if not user_info:
+                raise ValueError(f"User '{name}' doesn't exist.")
+            return [user_info]
+
+        if regex:
+            ret = await self.query(f"SELECT {USER_COLUMNS} FROM `{self.table}` "
+                                   "WHERE username REGEXP %s", (regex,))
+        else:
+            ret = await self.query(f"SELECT {USER_COLUMNS} FROM `{self.table}`")
+
+        return [pack_user_info(user) for user in ret]
+
+    async def change_user_password(self, user, new_password):
+        user = user.lower()
+        hash_ = await self.hash_password(new_password)
+
+        if not await self.execute(f"UPDATE `{self.table}` SET password=%s, salt=NULL "
+                                  "WHERE username=%s", (hash_, user)):
+            raise ValueError(f"User '{user}' doesn't exist.")
+        self.notify_user_changed(user)
+
+    async def verify_user_password(self, user, password_provided):
+        user_info = await self.query_user(user)
+
+        if not user_info:
+            raise ValueError(f"User '{user}' doesn't exist.")
+
+        return await self.check_password(user_info, password_provided)
+
+    def verify_legacy_hash(self, user_info, password):
+        _, hash_ = get_salted_hash(password, user_info.password_salt)
+        return hmac.compare_digest(user_info.password_hash, hash_)
+
+    async def update_user_login_info(self, user, ip, timestamp):
+        await self.execute(f"UPDATE `{self.table}` SET lastlogin=%s, ip=%s WHERE username=%s",
+                           (int(timestamp*1000), ip, user.lower()))
+
+    async def authenticate(self, user, password, ip, timestamp):
+        # As MysqlUserTable.authenticate(): one SELECT and one UPDATE.
+        user_info = await self.query_user(user)
+        if not user_info or not await self.check_password(user_info, password):
+            return False
+
+        user = user.lower()
+        if self.password_hasher.needs_rehash(user_info.password_hash):
+            hash_ = await self.hash_password(password)
+            await self.execute(f"UPDATE `{self.table}` SET password=%s, salt=NULL, lastlogin=%s, "
+                               "ip=%s WHERE username=%s",
+                               (hash_, int(timestamp*1000), ip, user))
+            self.notify_user_changed(user)
+        else:
+            await self.update_user_login_info(user, ip, timestamp)
+        return True
+
+    async def get_user_privilege_mask(self, user):
+        ret = await self.query(f"SELECT web_privileges FROM `{self.table}` WHERE username=%s",
+                               (user.lower(),))
+        if not ret:
+            raise ValueError(f"User '{user}' doesn't exist.")
+
+        return self.privilege_index.mask_of_string(ret[0][0] or "")
+
+    async def get_user_privileges(self, user):
+        user_info = await self.query_user(user)
+        if not user_info:
+            raise ValueError(f"User '{user}' doesn't exist.")
+
+        return user_info.privilege
+
+    async def change_user_privileges(self, user, privileges):
+        user = user.lower()
+        if not await self.execute(f"UPDATE `{self.table}` SET web_privileges=%s "
+                                  "WHERE username=%s",
+                                  (",".join(priv.lower() for priv in privileges), user)):
+            raise ValueError(f"User '{user}' doesn't exist.")
+        self.notify_user_changed(user)
+
+    async def update_user_privileges(self, user, update):
+        """Replace the privileges of `user` by `update(privileges)`, with
+        the row locked from the read to the write."""
+        user = user.lower()
+
+        async def _update(cursor):
+            await cursor.execute(f"SELECT web_privileges FROM `{self.table}` "
+                                 "WHERE username=%s FOR UPDATE", (user,))
+            rows = await cursor.fetchall()
+            if not rows:
+                raise ValueError(f"User '{user}' doesn't exist.")
+
+            privilege = update(rows[0][0].split(",") if rows[0][0] else [])
+            await cursor.execute(f"UPDATE `{self.table}` SET web_privileges=%s "
+                                 "WHERE username=%s", (",".join(privilege), user))
+
+        await self.transaction(_update)
+        self.notify_user_changed(user)
+
+    async def add_user_privileges(self, user, privileges):
+        def add(privilege):
+            for priv in privileges:
+                priv = priv.lower()
+                if priv not in privilege:
+                    privilege.append(priv)
+            return privilege
+
+        await self.update_user_privileges(user, add)
+
+    async def remove_user_privileges(self, user, privileges):
+        def remove(privilege):
+            for priv in privileges:
+                priv = priv.lower()
+                if priv in privilege:
+                    privilege.remove(priv)
+            return privilege
+
+        await self.update_user_privileges(user, remove)
@@ -1,15 +1,16 @@
 import os
 import re
-import secrets
-import hashlib
+import hmac
 import logging
-from datetime import datetime
 
 import mariadb
+from mariadb.constants import CLIENT
 
-from nslogin.storage.user_info import UserInfo
-from nslogin.storage.user_table import UserTable
-from nslogin.utils.misc import get
+from nslogin.storage.backends.mysql_common import (get_salted_hash,
+                                                   pack_user_info)
+from nslogin.storage.connection_pool import ConnectionPool
+from nslogin.storage.user_table import UserTable, check_user_name
+from nslogin.utils.misc import get, safeget
 
 logger = logging.getLogger('login')
 
@@ -22,32 +23,70 @@ def get_user_table(config):
         password = get(config, 'mysql', 'password')
         database = get(config, 'mysql', 'database')
         table = get(config, 'mysql', 'table')
+        pool_config = safeget(config, 'mysql', 'pool') or {}
 
-        return MysqlUserTable(user, password, database, table, host, port)
+        return MysqlUserTable(user, password, database, table, host, port,
+                              pool_config)
 
     except KeyError:
         raise KeyError("Invalid MySQL configuration!")
 
 
 class MysqlUserTable(UserTable):
-    def __init__(self, user, password, database, table, host, port):
+    def __init__(self, user, password, database, table, host, port,
+                 pool_config=None):
+        super().__init__()
         self.user_db_access = {
             'user': user,
             'password': password,
             'database': database,
             'host': host,
-            'port': port
+            'port': port,
+            'autocommit': True,
+            # UPDATE reports the rows matched rather than the rows changed,
+            # so that the affected row count tells whether the user exists.
+            'client_flag': CLIENT.FOUND_ROWS
         }
         self.table = table
 
+        pool_config = pool_config or {}
+        self.pool = ConnectionPool(
+            self.connect,
+            min_size=pool_config.get('min_size', 1),
+            max_size=pool_config.get('max_size', 10),
+            idle_timeout=pool_config.get('idle_timeout', 300),
+            checkout_timeout=pool_config.get('checkout_timeout', 10),
+            health_check_after=pool_config.get('health_check_after', 5),
+            health_check=lambda conn: conn.ping(),
+            connection_errors=(mariadb.InterfaceError, mariadb.OperationalError)
+        )
+
+    def connect(self):
+        return mariadb.connect(**self.user_db_access)
+
+    def run(self, func):
+        # A connection dropped by the server (timeout, restart) is only
+        # noticed when used, so retry once on a fresh connection.
+        try:
+            with self.pool.connection() as conn:
+                return func(conn)
+        except (mariadb.InterfaceError, mariadb.OperationalError) as e:
+            logger.warning(f"Mysql: connection failed ({e}), reconnecting.")
+            with self.pool.connection() as conn:
+                return func(conn)
+
+    def pool_stats(self):
+        return self.pool.stats()
+
+    def close(self):
+        self.pool.close()
+
     def create_table_if_not_exist(self):
         if self.query(f'SHOW TABLES LIKE {self.table}'):
             return
 
         logger.warning(f"Mysql: Table `{self.table}` doesn't exist. Create one.")
-        conn = mariadb.connect(**self.user_db_access)
-        cursor = conn.cursor()
-        cursor.execute(f"""
+        self.execute(f"""
         CREATE TABLE `{self.table}` (
               `id` mediumint(8) unsigned NOT NULL AUTO_INCREMENT,
               `username` varchar(255) NOT NULL,
@@ -62,46 +101,60 @@ class MysqlUserTable(UserTable):
             ) ENGINE=InnoDB AUTO_INCREMENT=2 DEFAULT CHARSET=utf8;
         """)
 
-        conn.commit()
-        cursor.close()
-        conn.close()
+    # Statements are sent as server-side prepared statements, executed
+    # directly along with their preparation.
 
     def query(self, sql_template, filler=[]):
-        conn = mariadb.connect(**self.user_db_access)
-        cursor = conn.cursor()
-        if filler:
-            cursor.execute(sql_template, filler)
-        else:
-            cursor.execute(sql_template)
-
-        ret = cursor.fetchall()
-
-        cursor.close()
-        conn.close()
-
-        return ret
-
-    def execute(self, sql_template, filler):
-        conn = mariadb.connect(**self.user_db_access)
-        cursor = conn.cursor()
-        cursor.execute(sql_template, filler)
-
-        conn.commit()
-        cursor.close()
-        conn.close()
-
-    @staticmethod
-    def pack_user_info(user_info_array):
-        timestamp = user_info_array[3]/1000 if user_info_array[3] else 0
-
-        return UserInfo(
-            name=user_info_array[0],
-            password_hash=user_info_array[1],
-            password_salt=user_info_array[2],
-            last_login_timestamp=datetime.fromtimestamp(timestamp).isoformat(),
-            last_login_ip=user_info_array[4],
-            privilege=user_info_array[5].split(",")
-        )
+        def _query(conn):
+            cursor = conn.cursor(prepared=True)
+            try:
+                if filler:
+                    cursor.execute(sql_template, filler)
+                else:
+                    cursor.execute(sql_template)
+
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+
+        return self.run(_query)
+
+    def execute(self, sql_template, filler=[]):
+        # Returns the affected row count. The connections are in autocommit
+        # mode, so the statement needs no COMMIT of its own.
+        def _execute(conn):
+            cursor = conn.cursor(prepared=True)
+            try:
+                if filler:
+                    cursor.execute(sql_template, filler)
+                else:
+                    cursor.execute(sql_template)
+
+                return cursor.rowcount
+            finally:
+                cursor.close()
+
+        return self.run(_execute)
+
+    def transaction(self, func):
+        """Run `func(cursor)` inside a transaction, which is rolled back if
+        it raises."""
+        def _transaction(conn):
+            cursor = conn.cursor(prepared=True)
+            try:
+                conn.begin()
+                result = func(cursor)
+                conn.commit()
+                return result
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+        return self.run(_transaction)
+
+    pack_user_info = staticmethod(pack_user_info)
 
     def query_user(self, user):
         user = user.lower()
@@ -126,7 +179,7 @@ class MysqlUserTable(UserTable):
     def query_users_regex(self, regex):
         ret = self.query("SELECT username, password, salt, lastlogin, ip, "
                          f"web_privileges FROM `{self.table}` "
-                         f"REGEXP {regex}")
+                         "WHERE username REGEXP ?", (regex,))
 
         if not ret:
             return None
@@ -141,26 +194,43 @@ class MysqlUserTable(UserTable):
             return False
 
     def add_user(self, user, password, privilege=None):
-        if self.has_user(user):
-            return False
-
-        salt, hash_ = self.get_salted_hash(password)
+        check_user_name(user)
+        hash_ = self.password_hasher.hash(password)
 
         if not privilege:
             privilege = ['default']
 
-        self.execute(f"INSERT INTO `{self.table}` "
-                     "(username, realname, password, salt, web_privileges) "
-                     "VALUES (?, ?, ?, ?, ?)",
-                     (user.lower(), user, hash_, salt, ",".join(privilege)))
+        # The unique key on username rejects an existing user.
+        try:
+            self.execute(f"INSERT INTO `{self.table}` "
+                         "(username, realname, password, salt, web_privileges) "
+                         "VALUES (?, ?, ?, NULL, ?)",
+                         (user.lower(), user, hash_, ",".join(privilege)))
+        except mariadb.IntegrityError:
+            return False
 
         return True
 
+    def add_users(self, users):
+        for user, _, _, _ in users:
+            check_user_name(user)
+
+        rows = [(user.lower(), user, hash_, salt or None, ",".join(privilege or ['default']))
+                for user, hash_, salt, privilege in users]
+
+        try:
+            self.transaction(lambda cursor: cursor.executemany(
+                f"INSERT INTO `{self.table}` "
+                "(username, realname, password, salt, web_privileges) "
+                "VALUES (?, ?, ?, ?, ?)", rows))
+        except mariadb.IntegrityError:
+            raise ValueError("Some of the users exist already.")
+
     def delete_user(self, user):
         user = user.lower()
-        if not self.has_user(user):
+        if not self.execute(f"DELETE FROM `{self.table}` WHERE username=?", (user,)):
             raise ValueError(f"User '{user}' doesn't exist.")
-        self.execute(f"DELETE FROM `{self.table}` WHERE username=?", (user,))
+        self.notify_user_changed(user)
 
     def list_users(self, name="", regex=""):
         name = name.lower()
@@ -178,13 +248,12 @@ class MysqlUserTable(UserTable):
 
     def change_user_password(self, user, new_password):
         user = user.lower()
-        if not self.has_user(user):
-            raise ValueError(f"User '{user}' doesn't exist.")
-
-        salt, hash_ = self.get_salted_hash(new_password)
+        hash_ = self.password_hasher.hash(new_password)
 
-        self.execute(f"UPDATE `{self.table}` SET password=?, salt=? WHERE username=?",
-                     (hash_, salt, user))
+        if not self.execute(f"UPDATE `{self.table}` SET password=?, salt=NULL "
+                            "WHERE username=?", (hash_, user)):
+            raise ValueError(f"User '{user}' doesn't exist.")
+        self.notify_user_changed(user)
 
     def verify_user_password(self, user, password_provided):
         user_info = self.query_user(user)
@@ -192,30 +261,42 @@ class MysqlUserTable(UserTable):
         if not user_info:
             raise ValueError(f"User '{user}' doesn't exist.")
 
-        _, hash_ = self.get_salted_hash(password_provided,
-                                        user_info.password_salt)
+        return self.check_password(user_info, password_provided)
 
-        return user_info.password_hash == hash_
+    def verify_legacy_hash(self, user_info, password):
+        _, hash_ = self.get_salted_hash(password, user_info.password_salt)
+        return hmac.compare_digest(user_info.password_hash, hash_)
 
     def update_user_login_info(self, user, ip, timestamp):
         self.execute(f"UPDATE `{self.table}` SET lastlogin=?, ip=? WHERE username=?",
-                     (int(timestamp*1000), ip, user))
-
-    def verify_user_privileges(self, user, privileges):
-        if not privileges:
-            privileges = ['default']
+                     (int(timestamp*1000), ip, user.lower()))
 
+    def authenticate(self, user, password, ip, timestamp):
+        # One SELECT, and one UPDATE recording the login along with the
+        # new hash if the password needs rehashing. The password is checked
+        # in between without holding a connection.
         user_info = self.query_user(user)
-        if not user_info:
-            raise ValueError(f"User '{user}' doesn't exist.")
-
-        for priv in privileges:
-            priv = priv.lower()
-            if priv not in user_info.privilege:
-                return False
+        if not user_info or not self.check_password(user_info, password):
+            return False
 
+        user = user.lower()
+        if self.password_hasher.needs_rehash(user_info.password_hash):
+            self.execute(f"UPDATE `{self.table}` SET password=?, salt=NULL, lastlogin=?, ip=? "
+                         "WHERE username=?",
+                         (self.password_hasher.hash(password), int(timestamp*1000), ip, user))
+            self.notify_user_changed(user)
+        else:
+            self.update_user_login_info(user, ip, timestamp)
         return True
 
+    def get_user_privilege_mask(self, user):
+        ret = self.query(f"SELECT web_privileges FROM `{self.table}` WHERE username=?",
+                         (user.lower(),))
+        if not ret:
+            raise ValueError(f"User '{user}' doesn't exist.")
+
+        return self.privilege_index.mask_of_string(ret[0][0] or "")
+
     def get_user_privileges(self, user):
         user_info = self.query_user(user)
         if not user_info:
@@ -224,46 +305,55 @@ class MysqlUserTable(UserTable):
         return user_info.privilege
 
     def change_user_privileges(self, user, privileges):
-        user_info = self.query_user(user)
-        if not user_info:
-            raise ValueError(f"User '{user}' doesn't exist.")
-
+        user = user.lower()
         privilege = []
         for priv in privileges:
             priv = priv.lower()
             privilege.append(priv)
 
-        self.execute(f"UPDATE `{self.table}` SET web_privileges=? WHERE username=?",
-                     (",".join(privilege), user))
-
-    def add_user_privileges(self, user, privileges):
-        user_info = self.query_user(user)
-        if not user_info:
+        if not self.execute(f"UPDATE `{self.table}` SET web_privileges=? WHERE username=?",
+                            (",".join(privilege), user)):
             raise ValueError(f"User '{user}' doesn't exist.")
+        self.notify_user_changed(user)
 
-        for priv in privileges:
-            priv = priv.lower()
-            if priv not in user_info.privilege:
-                user_info.privilege.append(priv)
+    def update_user_privileges(self, user, update):
+        """Replace the privileges of `user` by `update(privileges)`. The row
+        is locked from the read to the write, so that concurrent updates
+        don't overwrite each other."""
+        user = user.lower()
 
-        self.execute(f"UPDATE `{self.table}` SET web_privileges=? WHERE username=?",
-                     (",".join(user_info.privilege), user))
+        def _update(cursor):
+            cursor.execute(f"SELECT web_privileges FROM `{self.table}` "
+                           "WHERE username=? FOR UPDATE", (user,))
+            row = cursor.fetchone()
+            if not row:
+                raise ValueError(f"User '{user}' doesn't exist.")
 
-    def remove_user_privileges(self, user, privileges):
-        user_info = self.query_user(user)
-        if not user_info:
-            raise ValueError(f"User '{user}' doesn't exist.")
+            privilege = update(row[0].split(",") if row[0] else [])
+            cursor.execute(f"UPDATE `{self.table}` SET web_privileges=? WHERE username=?",
+                           (",".join(privilege), user))
 
-        for priv in privileges:
-            priv = priv.lower()
-            if priv in user_info.privilege:
-                user_info.privilege.remove(priv)
+        self.transaction(_update)
+        self.notify_user_changed(user)
+
+    def add_user_privileges(self, user, privileges):
+        def add(privilege):
+            for priv in privileges:
+                priv = priv.lower()
+                if priv not in privilege:
+                    privilege.append(priv)
+            return privilege
+
+        self.update_user_privileges(user, add)
+
+    def remove_user_privileges(self, user, privileges):
+        def remove(privilege):
+            for priv in privileges:
+                priv = priv.lower()
+                if priv in privilege:
+                    privilege.remove(priv)
+            return privilege
 
-        self.execute(f"UPDATE `{self.table}` SET web_privileges=? WHERE username=?",
-                     (",".join(user_info.privilege), user))
+        self.update_user_privileges(user, remove)
 
-    @staticmethod
-    def get_salted_hash(password, salt=None):
-        salt = secrets.token_hex(16) if not salt else salt
-        hash_ = hashlib.sha512((password + salt).encode('utf-8')).hexdigest()
-        return salt, hash_
+    get_salted_hash = staticmethod(get_salted_hash)
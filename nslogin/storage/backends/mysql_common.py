@@ -0,0 +1,28 @@
+import secrets
+import hashlib
+from datetime import datetime
+
+from nslogin.storage.user_info import UserInfo
+
+# Shared by the mariadb and the asyncio MySQL backends.
+
+USER_COLUMNS = "username, password, salt, lastlogin, ip, web_privileges"
+
+
+def pack_user_info(user_info_array):
+    timestamp = user_info_array[3]/1000 if user_info_array[3] else 0
+
+    return UserInfo(
+        name=user_info_array[0],
+        password_hash=user_info_array[1],
+        password_salt=user_info_array[2],
+        last_login_timestamp=datetime.fromtimestamp(timestamp).isoformat(),
+        last_login_ip=user_info_array[4],
+        privilege=user_info_array[5].split(",")
+    )
+
+
+def get_salted_hash(password, salt=None):
+    salt = secrets.token_hex(16) if not salt else salt
+    hash_ = hashlib.sha512((password + salt).encode('utf-8')).hexdigest()
+    return salt, hash_
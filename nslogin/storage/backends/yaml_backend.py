@@ -1,16 +1,37 @@
 import os
 import re
+import hmac
+import json
 import yaml
 import secrets
 import hashlib
 import logging
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 
 from nslogin.storage.user_info import UserInfo
-from nslogin.storage.user_table import UserTable
+from nslogin.storage.user_table import UserTable, check_user_name
+from nslogin.utils.file_watcher import FileWatcher, file_signature
+from nslogin.utils.misc import safeget, atomic_write
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 logger = logging.getLogger('login')
 
+# Use libyaml when available, it is an order of magnitude faster.
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+SafeDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+SNAPSHOT_CACHE_VERSION = 2
+
+# Fields of the records, as written to the file, changed together.
+PASSWORD_FIELDS = ('password_hash', 'password_salt')
+LOGIN_FIELDS = ('last_login_timestamp', 'last_login_ip')
+
 
 def get_user_table(config):
     user_table_path = config.get('user_table', 'user_table.yaml')
@@ -18,13 +39,56 @@ def get_user_table(config):
     if not os.path.exists(user_table_path):
         logger.warning("User table doesn't exist. A new one will be created.")
 
-    return YamlUserTable(user_table_path)
+    user_table = YamlUserTable(user_table_path,
+                               safeget(config, 'yaml', 'snapshot_cache') is not False)
+    if safeget(config, 'yaml', 'journal'):
+        user_table.start_journal(
+            compact_threshold=safeget(config, 'yaml', 'journal_compact_threshold') or 1000,
+            fsync=bool(safeget(config, 'yaml', 'journal_fsync')))
+    elif safeget(config, 'yaml', 'write_behind'):
+        user_table.start_write_behind(
+            interval=safeget(config, 'yaml', 'flush_interval') or 5,
+            threshold=safeget(config, 'yaml', 'flush_threshold') or 100)
+
+    return user_table
 
 
 class YamlUserTable(UserTable):
-    def __init__(self, user_info_file=None):
+    def __init__(self, user_info_file=None, snapshot_cache=True):
+        super().__init__()
         self.user_dict = {}
         self.user_info_file = user_info_file
+        self.journal_file = f"{user_info_file}.journal"
+        self.cache_file = f"{user_info_file}.cache" if snapshot_cache else None
+        self.lock_file = f"{user_info_file}.lock"
+        self.save_lock = threading.RLock()
+
+        # Users changed in memory but not written out yet, with the fields
+        # reload() must keep, or None for a whole record added or deleted.
+        # Guarded, with user_dict changes, by `lock`.
+        self.lock = threading.Lock()
+        self.unsaved = {}
+        # The signature of the files when they were last read or written,
+        # to notice changes made by other processes before writing.
+        self.signature = None
+        self.lock_fd = None
+        self.lock_depth = 0
+
+        self.watcher = None
+
+        self.journal = None
+        self.journal_fsync = False
+        self.journal_entries = 0
+        self.journal_compact_threshold = 1000
+
+        self.write_behind = False
+        self.flush_condition = threading.Condition()
+        self.flush_interval = 5
+        self.flush_threshold = 100
+        self.dirty = 0
+        self.flusher = None
+        self.closing = False
+
         self.load_from_file()
 
     def has_user(self, user):
@@ -34,31 +98,69 @@ class YamlUserTable(UserTable):
             return False
 
     def add_user(self, user, password, privilege=None):
+        check_user_name(user)
         user = user.lower()
         if user in self.user_dict:
             raise ValueError(f"User '{user}' exists.")
 
-        salt, hash_ = self.get_salted_hash(password)
+        hash_ = self.password_hasher.hash(password)
 
         if not privilege:
             privilege = ['default']
 
-        self.user_dict[user] = UserInfo(
-            name=user,
-            password_hash=hash_,
-            password_salt=salt.hex(),
-            last_login_timestamp=datetime.fromtimestamp(0).isoformat(),
-            last_login_ip="",
-            privilege=privilege
-        )
-        self.save_to_file()
+        with self.changing():
+            with self.lock:
+                if user in self.user_dict:
+                    raise ValueError(f"User '{user}' exists.")
+                self.user_dict[user] = UserInfo(
+                    name=user,
+                    password_hash=hash_,
+                    password_salt="",
+                    last_login_timestamp=datetime.fromtimestamp(0).isoformat(),
+                    last_login_ip="",
+                    privilege=privilege,
+                    privilege_mask=self.privilege_index.mask_of(privilege)
+                )
+                self.mark_unsaved(user)
+            self.save(user)
+
+    def add_users(self, users):
+        for user, _, _, _ in users:
+            check_user_name(user)
+
+        with self.changing():
+            with self.lock:
+                for user, _, _, _ in users:
+                    if user.lower() in self.user_dict:
+                        raise ValueError(f"User '{user.lower()}' exists.")
+
+                for user, hash_, salt, privilege in users:
+                    user = user.lower()
+                    privilege = list(privilege or ['default'])
+                    self.user_dict[user] = UserInfo(
+                        name=user,
+                        password_hash=hash_,
+                        password_salt=salt or "",
+                        last_login_timestamp=datetime.fromtimestamp(0).isoformat(),
+                        last_login_ip="",
+                        privilege=privilege,
+                        privilege_mask=self.privilege_index.mask_of(privilege)
+                    )
+                    self.mark_unsaved(user)
+
+            # One rewrite for the whole batch, which also folds in the journal.
+            self.save_to_file()
 
     def delete_user(self, user):
         user = user.lower()
-        if user not in self.user_dict:
-            raise ValueError(f"User '{user}' doesn't exist.")
-        del self.user_dict[user]
-        self.save_to_file()
+        with self.changing():
+            with self.lock:
+                if user not in self.user_dict:
+                    raise ValueError(f"User '{user}' doesn't exist.")
+                del self.user_dict[user]
+                self.mark_unsaved(user)
+            self.save(user)
+        self.notify_user_changed(user)
 
     def list_users(self, name="", regex=""):
         name = name.lower()
@@ -80,48 +182,46 @@ class YamlUserTable(UserTable):
         if user not in self.user_dict:
             raise ValueError(f"User '{user}' doesn't exist.")
 
-        salt, hash_ = self.get_salted_hash(new_password)
+        hash_ = self.password_hasher.hash(new_password)
 
-        self.user_dict[user].password_hash = hash_
-        self.user_dict[user].password_salt = salt.hex()
+        with self.changing():
+            with self.lock:
+                info = self.get_info(user)
+                info.password_hash = hash_
+                info.password_salt = ""
+                self.mark_unsaved(user, PASSWORD_FIELDS)
 
-        self.save_to_file()
+            self.save(user)
+        self.notify_user_changed(user)
 
     def verify_user_password(self, user, password_provided):
         user = user.lower()
         if user not in self.user_dict:
             raise ValueError(f"User '{user}' doesn't exist.")
 
-        _, hash_ = self.get_salted_hash(password_provided,
-                                        bytes.fromhex(
-                                            self.user_dict[user].password_salt))
+        return self.check_password(self.user_dict[user], password_provided)
 
-        return self.user_dict[user].password_hash == hash_
+    def verify_legacy_hash(self, user_info, password):
+        _, hash_ = self.get_salted_hash(password, bytes.fromhex(user_info.password_salt))
+        return hmac.compare_digest(user_info.password_hash, hash_)
 
     def update_user_login_info(self, user, ip, timestamp):
         user = user.lower()
-        if user not in self.user_dict:
-            raise ValueError(f"User '{user}' doesn't exist.")
-
-        self.user_dict[user].last_login_timestamp = datetime.fromtimestamp(timestamp).isoformat()
-        self.user_dict[user].last_login_ip = ip
-
-        self.save_to_file()
-
-    def verify_user_privileges(self, user, privileges):
-        user = user.lower()
-        if not privileges:
-            privileges = ['default']
+        with self.changing():
+            with self.lock:
+                info = self.get_info(user)
+                info.last_login_timestamp = datetime.fromtimestamp(timestamp).isoformat()
+                info.last_login_ip = ip
+                self.mark_unsaved(user, LOGIN_FIELDS)
 
-        if user not in self.user_dict:
-            raise ValueError(f"User '{user}' doesn't exist.")
+            self.save(user)
 
-        for priv in privileges:
-            priv = priv.lower()
-            if priv not in self.user_dict[user].privilege:
-                return False
+    def get_user_privilege_mask(self, user):
+        info = self.user_dict.get(user.lower())
+        if not info:
+            raise ValueError(f"User '{user.lower()}' doesn't exist.")
 
-        return True
+        return info.privilege_mask
 
     def get_user_privileges(self, user):
         user = user.lower()
@@ -132,39 +232,63 @@ class YamlUserTable(UserTable):
 
     def change_user_privileges(self, user, privileges):
         user = user.lower()
-        if user not in self.user_dict:
-            raise ValueError(f"User '{user}' doesn't exist.")
-
-        self.user_dict[user].privilege = []
-        for priv in privileges:
-            priv = priv.lower()
-            self.user_dict[user].privilege.append(priv)
-
-        self.save_to_file()
+        with self.changing():
+            with self.lock:
+                info = self.get_info(user)
+                info.privilege = []
+                for priv in privileges:
+                    priv = priv.lower()
+                    info.privilege.append(priv)
+
+                info.privilege_mask = self.privilege_index.mask_of(info.privilege)
+                self.mark_unsaved(user, ('privilege',))
+            self.save(user)
+        self.notify_user_changed(user)
 
     def add_user_privileges(self, user, privileges):
         user = user.lower()
-        if user not in self.user_dict:
-            raise ValueError(f"User '{user}' doesn't exist.")
-
-        for priv in privileges:
-            priv = priv.lower()
-            if priv not in self.user_dict[user].privilege:
-                self.user_dict[user].privilege.append(priv)
-
-        self.save_to_file()
+        with self.changing():
+            with self.lock:
+                info = self.get_info(user)
+                for priv in privileges:
+                    priv = priv.lower()
+                    if priv not in info.privilege:
+                        info.privilege.append(priv)
+
+                info.privilege_mask = self.privilege_index.mask_of(info.privilege)
+                self.mark_unsaved(user, ('privilege',))
+            self.save(user)
+        self.notify_user_changed(user)
 
     def remove_user_privileges(self, user, privileges):
         user = user.lower()
-        if user not in self.user_dict:
-            raise ValueError(f"User '{user}' doesn't exist.")
-
-        for priv in privileges:
-            priv = priv.lower()
-            if priv in self.user_dict[user].privilege:
-                self.user_dict[user].privilege.remove(priv)
+        with self.changing():
+            with self.lock:
+                info = self.get_info(user)
+                for priv in privileges:
+                    priv = priv.lower()
+                    if priv in info.privilege:
+                        info.privilege.remove(priv)
+
+                info.privilege_mask = self.privilege_index.mask_of(info.privilege)
+                self.mark_unsaved(user, ('privilege',))
+            self.save(user)
+        self.notify_user_changed(user)
+
+    def mark_unsaved(self, user, fields=None):
+        # With `lock` held.
+        if fields is None or (user in self.unsaved and self.unsaved[user] is None):
+            self.unsaved[user] = None
+        else:
+            self.unsaved[user] = self.unsaved.get(user, set()) | set(fields)
 
-        self.save_to_file()
+    def get_info(self, user):
+        # With `lock` held: the user may have been removed by a reload since
+        # the caller checked.
+        info = self.user_dict.get(user)
+        if not info:
+            raise ValueError(f"User '{user}' doesn't exist.")
+        return info
 
     @staticmethod
     def get_salted_hash(password, salt=None):
@@ -173,30 +297,360 @@ class YamlUserTable(UserTable):
         hash_ = hashlib.sha256(password_bytes + salt).hexdigest()
         return salt, hash_
 
+    def pack_user_info(self, user, info):
+        return UserInfo(
+            user,
+            info['password_hash'],
+            info['password_salt'],
+            info['last_login_timestamp'],
+            info['last_login_ip'],
+            info['privilege'],
+            self.privilege_index.mask_of(info['privilege'])
+        )
+
+    @staticmethod
+    def unpack_user_info(info):
+        return {
+            'password_hash': info.password_hash,
+            'password_salt': info.password_salt,
+            'last_login_timestamp': info.last_login_timestamp,
+            'last_login_ip': info.last_login_ip,
+            'privilege': list(info.privilege)
+        }
+
     def load_from_file(self):
+        self.signature = self.files_signature()
+        self.journal_entries = self.read_users(self.user_dict)
+
+    def files_signature(self):
+        return file_signature(self.user_info_file), file_signature(self.journal_file)
+
+    @contextmanager
+    def file_lock(self):
+        """Exclusive against other processes (e.g. nslogin-user and
+        nslogind) writing the user table, with `save_lock` held."""
+        if not fcntl:
+            yield
+            return
+
+        if self.lock_depth == 0:
+            if self.lock_fd is None:
+                self.lock_fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        self.lock_depth += 1
+        try:
+            yield
+        finally:
+            self.lock_depth -= 1
+            if self.lock_depth == 0:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    @contextmanager
+    def changing(self):
+        """Held while changing users. Unless writes are deferred, changes
+        made by other processes are read in first, and the change is made
+        and written with the files locked, so that it applies to the
+        current records."""
+        if self.write_behind:
+            yield
+            return
+
+        with self.save_lock, self.file_lock():
+            if self.files_signature() != self.signature:
+                self.reload()
+            yield
+
+    def read_users(self, user_dict):
         if os.path.exists(self.user_info_file):
-            with open(self.user_info_file, "r") as f:
-                user_dict = yaml.safe_load(f)
-
-                for user, info in user_dict.items():
-                    self.user_dict[user] = UserInfo(
-                        user,
-                        info['password_hash'],
-                        info['password_salt'],
-                        info['last_login_timestamp'],
-                        info['last_login_ip'],
-                        info['privilege']
-                    )
+            for user, info in self.load_snapshot().items():
+                user_dict[user] = self.pack_user_info(user, info)
+
+        return self.replay_journal(user_dict)
+
+    def watch_for_changes(self, interval=2):
+        self.watcher = FileWatcher([self.user_info_file, self.journal_file],
+                                   lambda path: self.reload(), interval)
+        self.watcher.start()
+
+    def reload(self):
+        # Called when another process (e.g. nslogin-user) changed the user
+        # table. Only users whose record differs are replaced, each with a
+        # single dict assignment, so readers are never blocked.
+        # Users changed here but not written yet keep the fields changed in
+        # memory (e.g. the last login), the others are read from the file,
+        # so that e.g. a privilege revoked meanwhile stays revoked. Users
+        # added or deleted here are kept as they are.
+        new_user_dict = {}
+        changed = []
+        with self.save_lock:
+            self.signature = self.files_signature()
+            self.journal_entries = self.read_users(new_user_dict)
+
+            with self.lock:
+                for user, info in new_user_dict.items():
+                    old_info = self.user_dict.get(user)
+                    if user in self.unsaved:
+                        fields = self.unsaved[user]
+                        if fields is None or not old_info:
+                            continue
+                        info = self.merge_info(user, info, old_info, fields)
+
+                    if (not old_info or
+                            self.unpack_user_info(old_info) != self.unpack_user_info(info)):
+                        self.user_dict[user] = info
+                        changed.append(user)
+
+                for user in list(self.user_dict.keys()):
+                    if user in new_user_dict:
+                        continue
+                    if user in self.unsaved and self.unsaved[user] is None:
+                        continue
+                    # Deleted by another process.
+                    self.unsaved.pop(user, None)
+                    self.user_dict.pop(user, None)
+                    changed.append(user)
+
+        if changed:
+            logger.info(f"Reloaded {len(changed)} users from {self.user_info_file}.")
+        for user in changed:
+            self.notify_user_changed(user)
+
+    def merge_info(self, user, info, unsaved_info, fields):
+        merged = self.unpack_user_info(info)
+        unsaved = self.unpack_user_info(unsaved_info)
+        for field in fields:
+            merged[field] = unsaved[field]
+        return self.pack_user_info(user, merged)
+
+    def load_snapshot(self):
+        with open(self.user_info_file, "rb") as f:
+            content = f.read()
+            stat = os.fstat(f.fileno())
+        digest = hashlib.sha256(content).hexdigest()
+
+        user_dict = self.read_snapshot_cache(stat, digest)
+        if user_dict is None:
+            user_dict = yaml.load(content, Loader=SafeLoader) or {}
+            self.write_snapshot_cache(user_dict, digest)
+
+        return user_dict
+
+    def read_snapshot_cache(self, stat, digest):
+        # The cache is the parsed user table as JSON, which holds data only,
+        # like SafeLoader. It is only trusted when it was made from a file
+        # with the same mtime, size and content.
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return None
+
+        try:
+            with open(self.cache_file, "r") as f:
+                cache = json.load(f)
+        except Exception:
+            logger.warning(f"Ignoring unreadable snapshot cache {self.cache_file}.")
+            return None
+
+        if (isinstance(cache, dict) and
+                cache.get('version') == SNAPSHOT_CACHE_VERSION and
+                cache.get('mtime_ns') == stat.st_mtime_ns and
+                cache.get('size') == stat.st_size and
+                cache.get('sha256') == digest):
+            return cache['users']
+        return None
+
+    def write_snapshot_cache(self, user_dict, digest):
+        if not self.cache_file:
+            return
+
+        stat = os.stat(self.user_info_file)
+        cache = {
+            'version': SNAPSHOT_CACHE_VERSION,
+            'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'sha256': digest,
+            'users': user_dict
+        }
+        try:
+            # e.g. timestamps parsed from a hand-edited file are kept as str.
+            atomic_write(self.cache_file, json.dumps(cache, default=str))
+        except OSError as e:
+            logger.warning(f"Cannot write snapshot cache {self.cache_file}: {e}")
+
+    def replay_journal(self, user_dict):
+        if not os.path.exists(self.journal_file):
+            return 0
+
+        entries = 0
+        with open(self.journal_file, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last entry may have been cut by a crash.
+                    logger.warning(f"Ignoring corrupted entry in {self.journal_file}.")
+                    continue
+
+                if entry['op'] == 'put':
+                    user_dict[entry['user']] = self.pack_user_info(entry['user'],
+                                                                   entry['info'])
+                elif entry['op'] == 'delete':
+                    user_dict.pop(entry['user'], None)
+                entries += 1
+
+        return entries
+
+    def start_journal(self, compact_threshold=1000, fsync=False):
+        # Every change is appended to the journal next to the user table,
+        # which is only rewritten once the journal holds
+        # `compact_threshold` entries.
+        self.journal_compact_threshold = compact_threshold
+        self.journal_fsync = fsync
+        self.journal = open(self.journal_file, "a")
+        if self.signature and self.signature[1] is None:
+            # Just created, empty.
+            self.signature = self.signature[0], file_signature(self.journal_file)
+
+        # Never append to a partially written last entry.
+        if self.journal.tell() > 0:
+            with open(self.journal_file, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self.journal.write("\n")
+
+    def append_to_journal(self, user):
+        with self.save_lock, self.file_lock():
+            with self.lock:
+                info = self.user_dict.get(user)
+                if info:
+                    entry = {'op': 'put', 'user': user, 'info': self.unpack_user_info(info)}
+                else:
+                    entry = {'op': 'delete', 'user': user}
+                self.unsaved.pop(user, None)
+
+            unchanged = self.files_signature() == self.signature
+            self.reopen_journal_if_replaced()
+            self.journal.write(json.dumps(entry) + "\n")
+            self.journal.flush()
+            if self.journal_fsync:
+                os.fsync(self.journal.fileno())
+            # Only our own entry was added, unless others wrote in between.
+            if unchanged:
+                self.signature = self.files_signature()
+            if self.watcher:
+                self.watcher.acknowledge(self.journal_file)
+
+            self.journal_entries += 1
+            if self.journal_entries >= self.journal_compact_threshold:
+                self.save_to_file()
+
+    def reopen_journal_if_replaced(self):
+        # With the files locked. The journal may have been removed or
+        # replaced by another process, e.g. an older version, and entries
+        # appended to the previous file would be lost.
+        try:
+            replaced = not os.path.samestat(os.stat(self.journal_file),
+                                            os.fstat(self.journal.fileno()))
+        except FileNotFoundError:
+            replaced = True
+
+        if replaced:
+            self.journal.close()
+            self.journal = open(self.journal_file, "a")
+
+    def start_write_behind(self, interval=5, threshold=100):
+        # Mutations only mark the table dirty, and a background thread
+        # writes it out every `interval` seconds or after `threshold`
+        # mutations, whichever comes first.
+        self.write_behind = True
+        self.flush_interval = interval
+        self.flush_threshold = threshold
+        self.flusher = threading.Thread(target=self.flush_loop,
+                                        name="user-table-flusher", daemon=True)
+        self.flusher.start()
+
+    def save(self, user):
+        if self.journal:
+            self.append_to_journal(user)
+            return
+
+        if not self.write_behind:
+            self.save_to_file()
+            return
+
+        with self.flush_condition:
+            self.dirty += 1
+            if self.dirty >= self.flush_threshold:
+                self.flush_condition.notify()
+
+    def flush_loop(self):
+        while True:
+            with self.flush_condition:
+                self.flush_condition.wait_for(
+                    lambda: self.dirty >= self.flush_threshold or self.closing,
+                    self.flush_interval)
+                if self.closing:
+                    return
+            self.flush()
+
+    def flush(self):
+        with self.flush_condition:
+            dirty, self.dirty = self.dirty, 0
+        if not dirty:
+            return
+
+        try:
+            self.save_to_file()
+        except Exception:
+            logger.exception(f"Failed to write user table {self.user_info_file}.")
+            with self.flush_condition:
+                self.dirty += dirty
+
+    def close(self):
+        if self.journal:
+            with self.save_lock:
+                self.journal.close()
+                self.journal = None
+
+        if self.lock_fd is not None:
+            with self.save_lock:
+                os.close(self.lock_fd)
+                self.lock_fd = None
+
+        if not self.write_behind:
+            return
+
+        with self.flush_condition:
+            self.closing = True
+            self.flush_condition.notify()
+        self.flusher.join()
+        self.flush()
 
     def save_to_file(self):
-        with open(self.user_info_file, "w") as f:
-            user_dict = {}
-            for user, info in self.user_dict.items():
-                user_dict[user] = {
-                    'password_hash': info.password_hash,
-                    'password_salt': info.password_salt,
-                    'last_login_timestamp': info.last_login_timestamp,
-                    'last_login_ip': info.last_login_ip,
-                    'privilege': info.privilege
-                }
-            yaml.dump(user_dict, f)
+        with self.save_lock, self.file_lock():
+            # Don't overwrite changes made by another process since the
+            # files were last read, merge them in first.
+            if self.files_signature() != self.signature:
+                self.reload()
+
+            with self.lock:
+                user_dict = {user: self.unpack_user_info(info)
+                             for user, info in self.user_dict.items()}
+                self.unsaved.clear()
+            content = yaml.dump(user_dict, Dumper=SafeDumper)
+            atomic_write(self.user_info_file, content)
+            self.write_snapshot_cache(
+                user_dict, hashlib.sha256(content.encode()).hexdigest())
+
+            # The snapshot now contains everything in the journal. It is
+            # emptied rather than removed, as journal writers keep it open.
+            if self.journal:
+                self.reopen_journal_if_replaced()
+                self.journal.truncate(0)
+            elif os.path.exists(self.journal_file) and os.path.getsize(self.journal_file):
+                with open(self.journal_file, "r+") as f:
+                    f.truncate(0)
+            self.journal_entries = 0
+            self.signature = self.files_signature()
+
+            if self.watcher:
+                self.watcher.acknowledge(self.user_info_file)
+                self.watcher.acknowledge(self.journal_file)
@@ -0,0 +1,177 @@
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger('login')
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Thread-safe pool of database connections.
+
+    :param connect: callable returning a new connection
+    :param min_size: connections kept open even when idle
+    :param max_size: upper bound of open connections
+    :param idle_timeout: seconds after which an idle connection above
+        `min_size` is closed
+    :param checkout_timeout: seconds to wait for a free connection
+    :param health_check: callable raising if a connection is broken,
+        run on checkout
+    :param health_check_after: seconds a connection must have been idle
+        to be health-checked on checkout; a connection that was just used
+        is assumed to be alive
+    :param connection_errors: exceptions raised while a connection is in
+        use that may mean it is broken, after which it is health-checked
+        before going back to the pool. Others, e.g. a duplicate key, leave
+        it as it is.
+    """
+
+    def __init__(self, connect, min_size=1, max_size=10, idle_timeout=300,
+                 checkout_timeout=10, health_check=None, health_check_after=0,
+                 connection_errors=(Exception,)):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.health_check = health_check
+        self.health_check_after = health_check_after
+        self.connection_errors = connection_errors
+
+        self.condition = threading.Condition()
+        self.idle = deque()  # (connection, returned_at)
+        self.size = 0
+        self.in_use = 0
+
+        self.checkouts = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.failures = 0
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except self.connection_errors:
+            self.release(conn, broken=not self.is_alive(conn))
+            raise
+        except Exception:
+            self.release(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def acquire(self):
+        start = time.monotonic()
+        deadline = start + self.checkout_timeout
+
+        with self.condition:
+            while True:
+                self._close_expired()
+
+                if self.idle:
+                    conn, returned_at = self.idle.pop()
+                    break
+
+                if self.size < self.max_size:
+                    self.size += 1
+                    conn = None
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f"No free connection in {self.checkout_timeout}s.")
+                self.condition.wait(remaining)
+
+            self.in_use += 1
+
+        try:
+            if (conn is not None and
+                    time.monotonic() - returned_at >= self.health_check_after and
+                    not self.is_alive(conn)):
+                logger.warning("Pool: discarding broken connection.")
+                self._close(conn)
+                conn = None
+            if conn is None:
+                conn = self.connect()
+        except Exception:
+            with self.condition:
+                self.size -= 1
+                self.in_use -= 1
+                self.failures += 1
+                self.condition.notify()
+            raise
+
+        wait = time.monotonic() - start
+        with self.condition:
+            self.checkouts += 1
+            self.total_wait_time += wait
+            self.max_wait_time = max(self.max_wait_time, wait)
+
+        return conn
+
+    def release(self, conn, broken=False):
+        with self.condition:
+            self.in_use -= 1
+            if broken:
+                self.size -= 1
+                self.failures += 1
+            else:
+                self.idle.append((conn, time.monotonic()))
+            self.condition.notify()
+
+        if broken:
+            self._close(conn)
+
+    def is_alive(self, conn):
+        if not self.health_check:
+            return True
+        try:
+            self.health_check(conn)
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        with self.condition:
+            idle = list(self.idle)
+            self.idle.clear()
+            self.size -= len(idle)
+
+        for conn, _ in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self.condition:
+            return {
+                'size': self.size,
+                'in_use': self.in_use,
+                'idle': len(self.idle),
+                'checkouts': self.checkouts,
+                'avg_wait_time': self.total_wait_time / self.checkouts if self.checkouts else 0.0,
+                'max_wait_time': self.max_wait_time,
+                'failures': self.failures,
+            }
+
+    def _close_expired(self):
+        # Oldest idle connections sit on the left, the most recently used
+        # ones are handed out from the right.
+        now = time.monotonic()
+        while (self.idle and self.size > self.min_size and
+               now - self.idle[0][1] > self.idle_timeout):
+            conn, _ = self.idle.popleft()
+            self.size -= 1
+            self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
@@ -0,0 +1,74 @@
+import re
+
+# rule     := or_expr
+# or_expr  := and_expr ('|' and_expr)*
+# and_expr := not_expr (('&' | '/') not_expr)*
+# not_expr := '!' not_expr | '(' or_expr ')' | NAME
+#
+# '/' is kept as an AND so that plain paths like "A/B" keep their meaning.
+
+TOKEN_REGEX = re.compile(r"\s*(?:([|&/!()])|([^|&/!()\s]+))")
+
+
+def tokenize(rule):
+    tokens = []
+    pos = 0
+    rule = rule.rstrip()
+    while pos < len(rule):
+        match = TOKEN_REGEX.match(rule, pos)
+        if not match:
+            raise ValueError(f"Invalid privilege rule: {rule}")
+        tokens.append(match[1] or ('name', match[2].lower()))
+        pos = match.end()
+    return tokens
+
+
+def parse_rule(rule):
+    """Parse a privilege rule into nested tuples: ('name', name),
+    ('not', node), ('and', [nodes]) and ('or', [nodes])."""
+    tokens = tokenize(rule)
+    if not tokens:
+        return 'name', 'default'
+
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def take():
+        nonlocal pos
+        token = peek()
+        pos += 1
+        return token
+
+    def or_expr():
+        nodes = [and_expr()]
+        while peek() == '|':
+            take()
+            nodes.append(and_expr())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def and_expr():
+        nodes = [not_expr()]
+        while peek() in ('&', '/'):
+            take()
+            nodes.append(not_expr())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def not_expr():
+        token = take()
+        if token == '!':
+            return 'not', not_expr()
+        if token == '(':
+            node = or_expr()
+            if take() != ')':
+                raise ValueError(f"Unbalanced parenthesis in privilege rule: {rule}")
+            return node
+        if isinstance(token, tuple):
+            return token
+        raise ValueError(f"Invalid privilege rule: {rule}")
+
+    node = or_expr()
+    if peek() is not None:
+        raise ValueError(f"Invalid privilege rule: {rule}")
+    return node
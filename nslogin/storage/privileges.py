@@ -0,0 +1,106 @@
+import logging
+import threading
+from functools import lru_cache
+
+from nslogin.storage.privilege_rule import parse_rule
+
+logger = logging.getLogger('login')
+
+
+def never(user_mask):
+    return False
+
+
+class PrivilegeIndex:
+    """Interns privilege names into bits, so that a user's privileges are
+    an integer mask.
+
+    Requested privileges, either a list of names (all required) or a rule
+    such as "(A|B)&!guest", are compiled once into an evaluator taking the
+    user's mask, and kept in an LRU cache. Names no user holds are never
+    interned from requests; they compile to a privilege nobody has.
+    """
+
+    def __init__(self, max_cached=4096):
+        self.max_cached = max_cached
+        self.lock = threading.Lock()
+        self.bits = {}
+        self.string_masks = {}
+        # Bumped whenever a name is interned. It is part of the cache key,
+        # so that a rule compiled concurrently with an intern() is not
+        # found again afterwards.
+        self.generation = 0
+        self.cached_compile = lru_cache(maxsize=max_cached)(self._compile)
+
+    def intern(self, name):
+        name = name.lower()
+        bit = self.bits.get(name)
+        if bit is None:
+            with self.lock:
+                bit = self.bits.get(name)
+                if bit is None:
+                    bit = 1 << len(self.bits)
+                    self.bits[name] = bit
+                    # Rules naming this privilege have to be compiled again.
+                    self.generation += 1
+                    self.cached_compile.cache_clear()
+        return bit
+
+    def mask_of(self, privileges):
+        mask = 0
+        for priv in privileges:
+            mask |= self.intern(priv)
+        return mask
+
+    def mask_of_string(self, privileges, separator=","):
+        mask = self.string_masks.get(privileges)
+        if mask is None:
+            mask = self.mask_of(privileges.split(separator) if privileges else [])
+            if len(self.string_masks) >= self.max_cached:
+                self.string_masks = {}
+            self.string_masks[privileges] = mask
+        return mask
+
+    def compile(self, privileges):
+        return self.cached_compile(privileges, self.generation)
+
+    def _compile(self, privileges, generation):
+        if isinstance(privileges, str):
+            try:
+                node = parse_rule(privileges)
+            except ValueError as e:
+                logger.error(str(e))
+                return never
+        else:
+            node = ('and', [('name', priv.lower()) for priv in privileges or ['default']])
+
+        return self.compile_node(node)
+
+    def compile_node(self, node):
+        kind, value = node
+
+        if kind == 'name':
+            bit = self.bits.get(value)
+            if bit is None:
+                return never
+            return lambda user_mask: user_mask & bit != 0
+
+        if kind == 'not':
+            operand = self.compile_node(value)
+            return lambda user_mask: not operand(user_mask)
+
+        # AND/OR over plain names, the common case, is a single mask test.
+        if all(child[0] == 'name' for child in value):
+            bits = [self.bits.get(child[1]) for child in value]
+            if kind == 'and':
+                if None in bits:
+                    return never
+                mask = sum(set(bits))
+                return lambda user_mask: user_mask & mask == mask
+            mask = sum(set(bit for bit in bits if bit is not None))
+            return lambda user_mask: user_mask & mask != 0
+
+        operands = [self.compile_node(child) for child in value]
+        if kind == 'and':
+            return lambda user_mask: all(operand(user_mask) for operand in operands)
+        return lambda user_mask: any(operand(user_mask) for operand in operands)
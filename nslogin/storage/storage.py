@@ -7,6 +7,8 @@ import re
 
 from importlib import import_module
 
+from nslogin.utils.password_hasher import PasswordHasher
+
 
 def list_all_backends():
     backends_dict = {}
@@ -44,4 +46,17 @@ def get_user_table(config):
         raise ValueError(f'Unsupported database backend: {backend_name}')
 
     backend = get_module(backends[backend_name])
-    return backend.get_user_table(config)
+    user_table = backend.get_user_table(config)
+    user_table.password_hasher = PasswordHasher.from_config(config.get('password'))
+    return user_table
+
+
+def get_async_user_table(config):
+    backend_name = config.get('db_backend', 'yaml')
+    if backend_name != 'mysql':
+        raise ValueError(f'No asyncio variant of the database backend: {backend_name}')
+
+    from .backends.async_mysql import get_async_user_table as get_table
+    user_table = get_table(config)
+    user_table.password_hasher = PasswordHasher.from_config(config.get('password'))
+    return user_table
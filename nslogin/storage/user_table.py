@@ -1,13 +1,51 @@
 from abc import ABC
 
+from nslogin.storage.privileges import PrivilegeIndex
+from nslogin.utils.password_hasher import PasswordHasher, is_kdf_hash
+
+
+def check_user_name(user):
+    # ':' separates the fields of signed session tokens.
+    if ":" in user:
+        raise ValueError(f"Invalid user name '{user}': ':' is not allowed.")
+
 
 class UserTable(ABC):
+    def __init__(self):
+        self.change_listeners = []
+        self.privilege_index = PrivilegeIndex()
+        self.password_hasher = PasswordHasher()
+
+    def add_change_listener(self, listener):
+        self.change_listeners.append(listener)
+
+    def notify_user_changed(self, user):
+        for listener in self.change_listeners:
+            listener(user.lower())
+
+    def watch_for_changes(self, interval=2):
+        pass
+
+    def close(self):
+        pass
+
     def has_user(self, user):
         raise NotImplementedError
 
     def add_user(self, user, password, privilege=None):
         raise NotImplementedError
 
+    def add_users(self, users):
+        """Add `users`, a list of (user, password_hash, password_salt,
+        privileges), in a single batch. Nothing is added if any of them
+        exists already."""
+        raise NotImplementedError
+
+    def hash_passwords(self, passwords):
+        # All hashes are queued at once, so that they are computed in parallel.
+        futures = [self.password_hasher.hash_future(password) for password in passwords]
+        return [future.result() for future in futures]
+
     def delete_user(self, user):
         raise NotImplementedError
 
@@ -23,7 +61,39 @@ class UserTable(ABC):
     def update_user_login_info(self, user, ip, timestamp):
         raise NotImplementedError
 
+    def check_password(self, user_info, password):
+        if is_kdf_hash(user_info.password_hash):
+            return self.password_hasher.verify(password, user_info.password_hash)
+        return self.verify_legacy_hash(user_info, password)
+
+    def verify_legacy_hash(self, user_info, password):
+        # Hashes made by the backend before PasswordHasher existed.
+        raise NotImplementedError
+
+    def authenticate(self, user, password, ip, timestamp):
+        """Check the password of `user` and record the login, replacing
+        a hash made with outdated parameters by a current one."""
+        if not self.has_user(user):
+            return False
+
+        user_info = self.list_users(name=user)[0]
+        if not self.check_password(user_info, password):
+            return False
+
+        if self.password_hasher.needs_rehash(user_info.password_hash):
+            self.change_user_password(user, password)
+        self.update_user_login_info(user, ip, timestamp)
+        return True
+
     def verify_user_privileges(self, user, privileges):
+        # The user's privileges are interned first, so that the request can
+        # be compiled against them.
+        user_mask = self.get_user_privilege_mask(user)
+        if not isinstance(privileges, str):
+            privileges = tuple(privileges)
+        return self.privilege_index.compile(privileges)(user_mask)
+
+    def get_user_privilege_mask(self, user):
         raise NotImplementedError
 
     def get_user_privileges(self, user):
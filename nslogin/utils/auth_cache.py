@@ -0,0 +1,99 @@
+import time
+import threading
+from collections import OrderedDict, namedtuple
+
+AuthDecision = namedtuple('AuthDecision', ['user', 'allowed', 'expire_at'])
+
+
+class AuthCache:
+    """Bounded LRU cache of auth_request decisions, keyed by
+    (token, privileges).
+
+    Entries expire after `ttl` seconds (or earlier, if `expire_at` is given
+    when the decision is stored), and can be dropped precisely by token
+    (logout) or by user (privilege changes, deletion).
+
+    Every invalidation of a user bumps their generation. A decision is only
+    stored if the generation read with `generation()` before making it is
+    still current, so that a decision made before a revocation is not
+    cached after it.
+    """
+
+    def __init__(self, max_size=10000, ttl=10):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.user_keys = {}
+        self.token_keys = {}
+        self.generations = {}  # user: number of invalidations
+
+    def get(self, token, privileges):
+        key = (token, privileges)
+        with self.lock:
+            decision = self.entries.get(key)
+            if decision is None:
+                return None
+
+            if decision.expire_at <= time.time():
+                self._remove(key)
+                return None
+
+            self.entries.move_to_end(key)
+            return decision
+
+    def generation(self, user):
+        return self.generations.get(user.lower(), 0)
+
+    def put(self, token, privileges, user, allowed, expire_at=None, generation=None):
+        key = (token, privileges)
+        user = user.lower()
+        now = time.time()
+        if expire_at is None or expire_at > now + self.ttl:
+            expire_at = now + self.ttl
+
+        with self.lock:
+            if generation is not None and generation != self.generations.get(user, 0):
+                return
+
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = AuthDecision(user, allowed, expire_at)
+            self.user_keys.setdefault(user, set()).add(key)
+            self.token_keys.setdefault(token, set()).add(key)
+
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate_user(self, user):
+        user = user.lower()
+        with self.lock:
+            self.generations[user] = self.generations.get(user, 0) + 1
+            for key in list(self.user_keys.get(user, ())):
+                self._remove(key)
+
+    def invalidate_token(self, token):
+        with self.lock:
+            for key in list(self.token_keys.get(token, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.user_keys.clear()
+            self.token_keys.clear()
+
+    def _remove(self, key):
+        decision = self.entries.pop(key)
+        token = key[0]
+
+        keys = self.user_keys[decision.user]
+        keys.discard(key)
+        if not keys:
+            del self.user_keys[decision.user]
+
+        keys = self.token_keys[token]
+        keys.discard(key)
+        if not keys:
+            del self.token_keys[token]
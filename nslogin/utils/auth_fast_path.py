@@ -0,0 +1,69 @@
+import re
+
+from werkzeug.http import generate_etag, quote_etag
+
+TOKEN_IN_COOKIE_REGEX = re.compile(r'(?:^|;)\s*token="?([^";]*)')
+TOKEN_IN_URI_REGEX = re.compile(r'[?&]token=([^&#]*)')
+
+EMPTY_HEADERS = [('Content-Length', '0')]
+
+
+class AuthFastPath:
+    """WSGI middleware answering /auth and /auth/<privileges> itself,
+    before the request reaches Flask and the ReverseProxied middleware.
+    Everything else is passed on to `app`.
+
+    :param app: the WSGI application
+    :param check_auth: callable (token, privileges, remote_addr) returning
+        the status code, 200, 401 or 403
+    :param forbidden_page: body of the 403 responses
+    """
+
+    def __init__(self, app, check_auth, forbidden_page):
+        self.app = app
+        self.check_auth = check_auth
+        self.forbidden_body = [forbidden_page.encode('utf-8')]
+        self.forbidden_headers = [('Content-Type', 'text/html; charset=utf-8'),
+                                  ('Content-Length', str(len(self.forbidden_body[0]))),
+                                  ('ETag', quote_etag(generate_etag(self.forbidden_body[0]))),
+                                  ('Cache-Control', 'no-cache')]
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+
+        script_name = environ.get('HTTP_X_SCRIPT_NAME')
+        if script_name and path.startswith(script_name):
+            path = path[len(script_name):]
+
+        if path == '/auth' or path == '/auth/':
+            privileges = 'default'
+        elif path.startswith('/auth/'):
+            # PEP 3333 paths are bytes decoded as latin-1.
+            privileges = path[6:].encode('latin-1').decode('utf-8', 'replace')
+        else:
+            return self.app(environ, start_response)
+
+        token = None
+        cookie = environ.get('HTTP_COOKIE')
+        if cookie:
+            match = TOKEN_IN_COOKIE_REGEX.search(cookie)
+            if match:
+                token = match[1]
+        if not token:
+            original_uri = environ.get('HTTP_X_ORIGINAL_URI')
+            if original_uri:
+                match = TOKEN_IN_URI_REGEX.search(original_uri)
+                if match:
+                    token = match[1]
+
+        remote_addr = environ.get('HTTP_X_REAL_IP') or environ.get('REMOTE_ADDR')
+        status = self.check_auth(token, privileges, remote_addr)
+
+        if status == 200:
+            start_response('200 OK', list(EMPTY_HEADERS))
+            return [b'']
+        if status == 403:
+            start_response('403 FORBIDDEN', list(self.forbidden_headers))
+            return self.forbidden_body
+        start_response('401 UNAUTHORIZED', list(EMPTY_HEADERS))
+        return [b'']
@@ -0,0 +1,82 @@
+import os
+import time
+import logging
+import threading
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+logger = logging.getLogger('login')
+
+
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class FileWatcher:
+    """Call `callback(path)` from a background thread whenever one of
+    `paths` is written, created, replaced or removed.
+
+    Uses inotify (through the optional `inotify_simple` package) when
+    available and falls back to polling the files' stat every `interval`
+    seconds.
+    """
+
+    def __init__(self, paths, callback, interval=2):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.callback = callback
+        self.interval = interval
+        self.signatures = {path: file_signature(path) for path in self.paths}
+        self.thread = None
+
+    def start(self):
+        if inotify_simple:
+            target = self.watch_inotify
+        else:
+            target = self.watch_poll
+        self.thread = threading.Thread(target=target, name="file-watcher", daemon=True)
+        self.thread.start()
+
+    def acknowledge(self, path):
+        # Changes made by ourselves don't need to be reported.
+        path = os.path.abspath(path)
+        self.signatures[path] = file_signature(path)
+
+    def check(self):
+        for path in self.paths:
+            signature = file_signature(path)
+            if signature != self.signatures[path]:
+                self.signatures[path] = signature
+                try:
+                    self.callback(path)
+                except Exception:
+                    logger.exception(f"Failed to handle the change of {path}.")
+
+    def watch_poll(self):
+        while True:
+            time.sleep(self.interval)
+            self.check()
+
+    def watch_inotify(self):
+        # Watch the directories, since files are replaced by rename().
+        flags = inotify_simple.flags
+        mask = (flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE |
+                flags.DELETE | flags.MODIFY)
+        inotify = inotify_simple.INotify()
+        for dirname in {os.path.dirname(path) for path in self.paths}:
+            inotify.add_watch(dirname, mask)
+
+        names = {os.path.basename(path) for path in self.paths}
+        while True:
+            events = inotify.read(timeout=self.interval * 1000)
+            if any(event.name in names for event in events):
+                # Let a burst of writes settle before reading the files.
+                time.sleep(0.05)
+                inotify.read(timeout=0)
+            self.check()
@@ -0,0 +1,138 @@
+import os
+import yaml
+import logging
+import threading
+
+from nslogin.utils.file_watcher import FileWatcher
+from nslogin.utils.misc import atomic_write
+
+logger = logging.getLogger('login')
+
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+SafeDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+class InvitationCodeStore:
+    """The invitation codes of `path` (a YAML list), held in a set.
+
+    `consume()` removes a code atomically, so that two registrations can't
+    use the same one. If `dispose_used` is set, the removals are written
+    back to the file every `flush_interval` seconds or after
+    `flush_threshold` of them, whichever comes first. Changes made to the
+    file by others are picked up once `watch()` has been called.
+    """
+
+    def __init__(self, path, dispose_used=True, flush_interval=5, flush_threshold=100):
+        self.path = path
+        self.dispose_used = dispose_used
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.codes = set()
+        self.used = set()  # consumed, but still in the file
+
+        self.watcher = None
+        self.flush_condition = threading.Condition()
+        self.closing = False
+        self.flusher = None
+
+        self.load()
+
+        if dispose_used:
+            self.flusher = threading.Thread(target=self.flush_loop,
+                                            name="invitation-code-flusher", daemon=True)
+            self.flusher.start()
+
+    def read_file(self):
+        if not os.path.exists(self.path):
+            logger.error(f'Cannot read invitation code file {self.path}')
+            return []
+
+        with open(self.path, "r") as f:
+            return yaml.load(f, Loader=SafeLoader) or []
+
+    def load(self, path=None):
+        codes = {str(code) for code in self.read_file()}
+        with self.lock:
+            self.codes = codes - self.used
+            # Codes removed from the file don't need to be removed again.
+            self.used &= codes
+
+    def watch(self, interval=2):
+        self.watcher = FileWatcher([self.path], self.load, interval)
+        self.watcher.start()
+
+    def __contains__(self, code):
+        return code in self.codes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def consume(self, code):
+        if not self.dispose_used:
+            return code in self.codes
+
+        with self.lock:
+            if code not in self.codes:
+                return False
+            self.codes.remove(code)
+            self.used.add(code)
+            pending = len(self.used)
+
+        if pending >= self.flush_threshold:
+            with self.flush_condition:
+                self.flush_condition.notify()
+        return True
+
+    def restore(self, code):
+        # Give back a code whose registration failed after all.
+        if not self.dispose_used:
+            return
+
+        with self.lock:
+            if code in self.used:
+                self.used.remove(code)
+                self.codes.add(code)
+
+    def flush_loop(self):
+        while True:
+            with self.flush_condition:
+                self.flush_condition.wait_for(
+                    lambda: len(self.used) >= self.flush_threshold or self.closing,
+                    self.flush_interval)
+                if self.closing:
+                    return
+            self.flush()
+
+    def flush(self):
+        with self.save_lock:
+            with self.lock:
+                used = set(self.used)
+            if not used:
+                return
+
+            try:
+                # Rewrite from the file itself, so that codes added by others
+                # in the meantime are kept.
+                codes = [code for code in self.read_file() if str(code) not in used]
+                atomic_write(self.path, yaml.dump(codes, Dumper=SafeDumper))
+            except Exception:
+                logger.exception(f"Failed to write invitation code file {self.path}.")
+                return
+
+            with self.lock:
+                self.used -= used
+            if self.watcher:
+                self.watcher.acknowledge(self.path)
+
+    def close(self):
+        if not self.flusher:
+            return
+
+        with self.flush_condition:
+            self.closing = True
+            self.flush_condition.notify()
+        self.flusher.join()
+        self.flush()
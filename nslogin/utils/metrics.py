@@ -0,0 +1,163 @@
+import time
+import threading
+from bisect import bisect_left
+
+from nslogin.utils.misc import MethodWrapper
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class MetricShard:
+    __slots__ = ('counters', 'histograms')
+
+    def __init__(self):
+        self.counters = {}  # (name, labels): value
+        self.histograms = {}  # (name, labels): [count per bucket..., +Inf, sum]
+
+    def merge(self, other):
+        for key, value in list(other.counters.items()):
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, values in list(other.histograms.items()):
+            total = self.histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(list(values)):
+                total[i] += value
+
+
+class Metrics:
+    """Counters and histograms in the Prometheus text format.
+
+    Every thread records into its own shard, so recording takes no lock;
+    the shards are only summed up by `render()`. The shard of a thread
+    which has ended is folded into `retired` when a new thread starts
+    recording or on `render()`, so that a server starting a thread per
+    request doesn't keep one shard for each. Labels are given as tuples
+    of (name, value) pairs.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.local = threading.local()
+        self.shards = []  # [(thread, shard)]
+        self.retired = MetricShard()
+        self.shards_lock = threading.Lock()
+        self.descriptions = {}  # name: (type, help)
+        self.gauges = {}  # name: callback returning [(labels, value)]
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = MetricShard()
+            with self.shards_lock:
+                self.retire_shards()
+                self.shards.append((threading.current_thread(), shard))
+            return shard
+
+    def retire_shards(self):
+        # With shards_lock held. An ended thread doesn't record anymore,
+        # so its shard can be merged without a race.
+        live = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self.retired.merge(shard)
+        self.shards = live
+
+    def describe(self, name, type_, help_):
+        self.descriptions[name] = (type_, help_)
+
+    def add_gauge(self, name, help_, callback):
+        self.describe(name, 'gauge', help_)
+        self.gauges[name] = callback
+
+    def inc(self, name, labels=(), value=1):
+        counters = self.shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        histograms = self.shard().histograms
+        key = (name, labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        histogram[bisect_left(self.buckets, value)] += 1
+        histogram[-1] += value
+
+    def timed(self, name, labels, func):
+        def timed_func(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe(name, labels, time.perf_counter() - start)
+        return timed_func
+
+    def collect(self):
+        total = MetricShard()
+        with self.shards_lock:
+            self.retire_shards()
+            total.merge(self.retired)
+            shards = [shard for _, shard in self.shards]
+
+        for shard in shards:
+            total.merge(shard)
+
+        return total.counters, total.histograms
+
+    def render(self):
+        counters, histograms = self.collect()
+
+        samples = {}  # name: [line]
+        for (name, labels), value in sorted(counters.items()):
+            samples.setdefault(name, []).append(
+                f"{name}{format_labels(labels)} {format_value(value)}")
+
+        for (name, labels), values in sorted(histograms.items()):
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                le = (('le', bound if bound == '+Inf' else format_value(bound)),)
+                lines.append(f"{name}_bucket{format_labels(labels + le)} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {format_value(values[-1])}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+
+        for name, callback in self.gauges.items():
+            samples[name] = [f"{name}{format_labels(labels)} {format_value(value)}"
+                             for labels, value in callback()]
+
+        output = []
+        for name in sorted(samples):
+            if name in self.descriptions:
+                type_, help_ = self.descriptions[name]
+                output.append(f"# HELP {name} {help_}")
+                output.append(f"# TYPE {name} {type_}")
+            output.extend(samples[name])
+        return "\n".join(output) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"'
+                          for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class TimedUserTable(MethodWrapper):
+    """Proxy of a UserTable recording the duration of every method call in
+    `nslogin_user_table_call_duration_seconds`."""
+
+    def __init__(self, user_table, metrics):
+        super().__init__(user_table, lambda name, method: metrics.timed(
+            'nslogin_user_table_call_duration_seconds', (('method', name),), method))
@@ -1,3 +1,8 @@
+import os
+import stat
+import tempfile
+
+
 def safeget(dct, *keys):
     for key in keys:
         try:
@@ -11,3 +16,44 @@ def get(dct, *keys):
     for key in keys:
         dct = dct[key]
     return dct
+
+
+def atomic_write(path, data):
+    """Replace the content of `path` with `data` (str or bytes) so that
+    readers see either the old or the new file, never a truncated one."""
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname,
+                                    prefix=f".{os.path.basename(path)}.")
+    try:
+        if os.path.exists(path):
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+
+        with os.fdopen(fd, "wb" if isinstance(data, bytes) else "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+class MethodWrapper:
+    """Proxy of `target` whose public methods are replaced by
+    `wrap(name, method)`. Other attributes are passed through."""
+
+    def __init__(self, target, wrap):
+        self.target = target
+        self.wrap = wrap
+
+    def __getattr__(self, attr):
+        value = getattr(self.target, attr)
+        if attr.startswith('_') or not callable(value):
+            return value
+
+        wrapped = self.wrap(attr, value)
+        # Found in the instance dict from now on.
+        self.__dict__[attr] = wrapped
+        return wrapped
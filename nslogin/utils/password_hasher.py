@@ -0,0 +1,146 @@
+import hmac
+import base64
+import hashlib
+import secrets
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+
+ALGORITHMS = ('scrypt', 'pbkdf2-sha256')
+
+
+def derive(algorithm, password, salt, params):
+    # Runs in the worker processes, hence at module level.
+    if algorithm == 'scrypt':
+        n, r, p = params['n'], params['r'], params['p']
+        return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                              maxmem=256 * n * r, dklen=32)
+    if algorithm == 'pbkdf2-sha256':
+        return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt,
+                                   params['i'], dklen=32)
+    raise ValueError(f"Unsupported password hash algorithm: {algorithm}")
+
+
+def b64encode(data):
+    return base64.b64encode(data).decode('ascii').rstrip('=')
+
+
+def b64decode(data):
+    return base64.b64decode(data + '=' * (-len(data) % 4))
+
+
+def encode(algorithm, params, salt, key):
+    params = ",".join(f"{name}={value}" for name, value in params.items())
+    return f"${algorithm}${params}${b64encode(salt)}${b64encode(key)}"
+
+
+def decode(encoded):
+    _, algorithm, params, salt, key = encoded.split('$')
+    params = {name: int(value) for name, value in
+              (param.split('=') for param in params.split(','))}
+    return algorithm, params, b64decode(salt), b64decode(key)
+
+
+def is_kdf_hash(encoded):
+    return bool(encoded) and encoded.startswith('$') and \
+        encoded.split('$')[1] in ALGORITHMS
+
+
+class PasswordHasher:
+    """Hashes passwords with scrypt or PBKDF2, storing the parameters and
+    the salt within the hash (`$scrypt$n=32768,r=8,p=1$<salt>$<key>`), so
+    that they can be raised later while old hashes stay valid.
+
+    The key derivation runs in a pool of `workers` processes, so that it
+    neither blocks the calling thread's peers on the GIL nor uses more than
+    `workers` cores at once; further requests queue. With `workers: 0`,
+    hashes are computed in the calling thread.
+    """
+
+    def __init__(self, algorithm='scrypt', scrypt_n=2 ** 15, scrypt_r=8, scrypt_p=1,
+                 pbkdf2_iterations=600000, workers=2):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unsupported password hash algorithm: {algorithm}")
+
+        self.algorithm = algorithm
+        if algorithm == 'scrypt':
+            self.params = {'n': scrypt_n, 'r': scrypt_r, 'p': scrypt_p}
+        else:
+            self.params = {'i': pbkdf2_iterations}
+
+        self.workers = workers
+        self.executor = None
+        self.executor_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        config = config or {}
+        return cls(algorithm=config.get('algorithm', 'scrypt'),
+                   scrypt_n=config.get('scrypt_n', 2 ** 15),
+                   scrypt_r=config.get('scrypt_r', 8),
+                   scrypt_p=config.get('scrypt_p', 1),
+                   pbkdf2_iterations=config.get('pbkdf2_iterations', 600000),
+                   workers=config.get('workers', 2))
+
+    def submit(self, *args):
+        if not self.workers:
+            future = Future()
+            try:
+                future.set_result(derive(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        with self.executor_lock:
+            if self.executor is None:
+                # Created on first use, i.e. after a prefork server has forked.
+                # Don't fork the worker processes from a threaded server.
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('forkserver'))
+        return self.executor.submit(derive, *args)
+
+    def hash_future(self, password):
+        salt = secrets.token_bytes(16)
+        params = dict(self.params)
+        future = Future()
+
+        def done(key_future):
+            try:
+                future.set_result(encode(self.algorithm, params, salt, key_future.result()))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.submit(self.algorithm, password, salt, params).add_done_callback(done)
+        return future
+
+    def verify_future(self, password, encoded):
+        algorithm, params, salt, key = decode(encoded)
+        future = Future()
+
+        def done(key_future):
+            try:
+                future.set_result(hmac.compare_digest(key_future.result(), key))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.submit(algorithm, password, salt, params).add_done_callback(done)
+        return future
+
+    def hash(self, password):
+        return self.hash_future(password).result()
+
+    def verify(self, password, encoded):
+        return self.verify_future(password, encoded).result()
+
+    def needs_rehash(self, encoded):
+        if not is_kdf_hash(encoded):
+            return True
+        algorithm, params, _, _ = decode(encoded)
+        return algorithm != self.algorithm or params != self.params
+
+    def close(self):
+        with self.executor_lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+                self.executor = None
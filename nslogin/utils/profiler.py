@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+import logging
+import tempfile
+import threading
+from collections import Counter
+
+logger = logging.getLogger('login')
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads every `interval` seconds, from a
+    background thread, and writes them in the collapsed format of
+    flamegraph.pl / speedscope ("thread;outer;...;inner count" per line).
+
+    Only one profile runs at a time.
+    """
+
+    def __init__(self, interval=0.005, output_dir=None):
+        self.interval = interval
+        self.output_dir = output_dir or tempfile.gettempdir()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self, duration):
+        """Profile for `duration` seconds. Returns the path of the file the
+        profile will be written to, or None if one is already running."""
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return None
+
+            path = os.path.join(self.output_dir, f"nslogind-{os.getpid()}-"
+                                                 f"{time.strftime('%Y%m%d-%H%M%S')}.folded")
+            self.thread = threading.Thread(target=self.run, args=(duration, path),
+                                           name="sampling-profiler", daemon=True)
+            self.thread.start()
+
+        logger.info(f"Profiling for {duration}s into {path}.")
+        return path
+
+    def run(self, duration, path):
+        own_id = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                                 f":{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                stacks[";".join(reversed(stack))] += 1
+
+            samples += 1
+            time.sleep(self.interval)
+
+        try:
+            with open(path, "w") as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        except OSError:
+            logger.exception(f"Failed to write profile {path}.")
+            return
+
+        logger.info(f"Profile written to {path} ({samples} samples).")
@@ -0,0 +1,66 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class TokenBuckets:
+    """One token bucket per key, refilled at `rate` tokens per second up to
+    `burst` tokens.
+
+    At most `max_keys` buckets are kept, the least recently used one being
+    dropped first; a dropped key starts again with a full bucket.
+    """
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()  # key: (tokens, updated_at)
+
+    def peek(self, key, now):
+        tokens, updated_at = self.buckets.get(key, (self.burst, now))
+        return min(self.burst, tokens + (now - updated_at) * self.rate)
+
+    def take(self, key, now):
+        self.buckets[key] = (self.peek(key, now) - 1, now)
+        self.buckets.move_to_end(key)
+        while len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+
+
+class LoginRateLimit:
+    """Throttles login attempts per client address and per user name,
+    before any storage lookup or password hashing happens.
+
+    An attempt is allowed when both buckets hold a token, and then takes
+    one from each.
+    """
+
+    def __init__(self, ip_rate=1, ip_burst=20, user_rate=0.1, user_burst=10,
+                 max_keys=100000):
+        self.ip_buckets = TokenBuckets(ip_rate, ip_burst, max_keys)
+        self.user_buckets = TokenBuckets(user_rate, user_burst, max_keys)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        config = config or {}
+        per_ip = config.get('per_ip') or {}
+        per_user = config.get('per_user') or {}
+        return cls(ip_rate=per_ip.get('rate', 1),
+                   ip_burst=per_ip.get('burst', 20),
+                   user_rate=per_user.get('rate', 0.1),
+                   user_burst=per_user.get('burst', 10),
+                   max_keys=config.get('max_keys', 100000))
+
+    def allow(self, ip, user):
+        now = time.monotonic()
+        user = user.lower()
+        with self.lock:
+            if (self.ip_buckets.peek(ip, now) < 1 or
+                    self.user_buckets.peek(user, now) < 1):
+                return False
+
+            self.ip_buckets.take(ip, now)
+            self.user_buckets.take(user, now)
+            return True
@@ -0,0 +1,83 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager, nullcontext
+
+logger = logging.getLogger('login')
+
+
+class RequestTracer:
+    """Accumulates the time spent in named phases (token lookup, privilege
+    check, backend, rendering, ...) by the request of the current thread.
+    Outside of a traced request, recording is a no-op."""
+
+    def __init__(self, threshold=None):
+        self.threshold = threshold
+        self.local = threading.local()
+
+    def begin(self):
+        self.local.phases = {}
+
+    def end(self):
+        phases, self.local.phases = self.local.phases, None
+        return phases
+
+    def add(self, phase, duration):
+        phases = getattr(self.local, 'phases', None)
+        if phases is not None:
+            phases[phase] = phases.get(phase, 0) + duration
+
+    def phase(self, name):
+        """Context manager adding the time spent in it to phase `name`."""
+        if getattr(self.local, 'phases', None) is None:
+            return nullcontext()
+        return self.timed_phase(name)
+
+    @contextmanager
+    def timed_phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+
+class RequestTracing:
+    """WSGI middleware logging the requests that take longer than the
+    tracer's threshold, with the time spent in each phase. Like
+    ReverseProxied, it goes around the whole application, so that the
+    /auth fast path is traced as well.
+
+    :param app: the WSGI application
+    :param tracer: the RequestTracer the application records phases into
+    """
+
+    def __init__(self, app, tracer):
+        self.app = app
+        self.tracer = tracer
+
+    def __call__(self, environ, start_response):
+        status = []
+
+        def traced_start_response(status_, headers, exc_info=None):
+            status.append(status_.split(' ', 1)[0])
+            return start_response(status_, headers, exc_info)
+
+        self.tracer.begin()
+        start = time.perf_counter()
+        try:
+            return self.app(environ, traced_start_response)
+        finally:
+            duration = time.perf_counter() - start
+            phases = self.tracer.end()
+            if duration >= self.tracer.threshold:
+                self.log(environ, status[0] if status else '-', duration, phases)
+
+    @staticmethod
+    def log(environ, status, duration, phases):
+        breakdown = [f"{phase} {seconds * 1000:.1f}ms"
+                     for phase, seconds in sorted(phases.items(), key=lambda item: -item[1])]
+        breakdown.append(f"other {(duration - sum(phases.values())) * 1000:.1f}ms")
+        logger.warning(f"Slow request: {environ.get('REQUEST_METHOD')} "
+                       f"{environ.get('SCRIPT_NAME', '')}{environ.get('PATH_INFO', '')} "
+                       f"{status} took {duration * 1000:.1f}ms ({', '.join(breakdown)}).")
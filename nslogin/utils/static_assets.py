@@ -0,0 +1,64 @@
+import os
+import json
+import logging
+import mimetypes
+
+from flask import send_from_directory
+
+logger = logging.getLogger('login')
+
+# Preferred first.
+PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+
+
+class StaticAssets:
+    """The files built by webpack into `directory`.
+
+    `static/manifest.json` maps the asset names used in the templates
+    (e.g. 'js/login.js') to their content-hashed file names. Without a
+    manifest, e.g. while `npm run watch` rebuilds the plain files, the names
+    are used as they are.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest = {}
+
+        manifest_path = os.path.join(directory, 'manifest.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+        else:
+            logger.warning(f"No asset manifest in {directory}, "
+                           "static files are served without long-term caching.")
+
+        self.hashed_files = set(self.manifest.values())
+
+    def url(self, name):
+        # Relative to the page, as nslogind may be mounted under any prefix.
+        return "static/" + self.manifest.get(name, name)
+
+    def send(self, filename, accept_encodings):
+        """Send `filename`, or its .br or .gz sibling if the client accepts
+        it. Content-hashed files are marked immutable."""
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        immutable = filename in self.hashed_files
+
+        encoding = None
+        for candidate, suffix in PRECOMPRESSED:
+            if (accept_encodings[candidate] and
+                    os.path.isfile(os.path.join(self.directory, filename + suffix))):
+                encoding = candidate
+                filename = filename + suffix
+                break
+
+        resp = send_from_directory(self.directory, filename, mimetype=mimetype)
+        if encoding:
+            resp.headers['Content-Encoding'] = encoding
+        resp.vary.add('Accept-Encoding')
+
+        if immutable:
+            resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            resp.headers['Cache-Control'] = 'no-cache'
+        return resp
@@ -11,6 +11,10 @@ setup(
     keywords="",
     platforms="any",
     install_requires=["flask", "pyyaml"],
+    extras_require={
+        "server": ["gunicorn"],
+        "asgi": ["uvicorn", "asgiref", "aiomysql", "mariadb"],
+    },
     classifiers=[
         "License :: OSI Approved :: GNU Lesser General Public License v2 "
         "or later (LGPLv2+)",
@@ -0,0 +1,238 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from nslogin.storage.async_pool import AsyncConnectionPool
+from nslogin.storage.backends.async_mysql import AsyncMysqlUserTable
+from nslogin.storage.connection_pool import PoolTimeout
+from nslogin.utils.password_hasher import PasswordHasher
+
+
+class FakeDriver:
+    """An aiomysql stand-in over SQLite, counting the statements sent and
+    failing the next `failures` of them with ConnectionError."""
+
+    def __init__(self):
+        self.db = sqlite3.connect(':memory:', isolation_level=None)
+        self.db.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, "
+                        "username TEXT UNIQUE, realname TEXT, password TEXT, salt TEXT, "
+                        "ip TEXT, lastlogin INTEGER, web_privileges TEXT)")
+        self.statements = []
+        self.failures = 0
+        self.row_lock = None
+        self.connections = 0
+
+    async def connect(self, **kwargs):
+        self.connections += 1
+        return FakeConnection(self)
+
+
+class FakeConnection:
+    def __init__(self, driver):
+        self.driver = driver
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self.driver)
+
+    async def ping(self, reconnect):
+        if self.closed:
+            raise ConnectionError("closed")
+
+    async def begin(self):
+        # One transaction at a time stands for the row lock.
+        if self.driver.row_lock is None:
+            self.driver.row_lock = asyncio.Lock()
+        await self.driver.row_lock.acquire()
+
+    async def commit(self):
+        self.driver.row_lock.release()
+
+    async def rollback(self):
+        self.driver.row_lock.release()
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCursor:
+    def __init__(self, driver):
+        self.driver = driver
+        self.rows = []
+        self.rowcount = -1
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def execute(self, sql, args=None):
+        await asyncio.sleep(0.001)
+        if self.driver.failures:
+            self.driver.failures -= 1
+            raise ConnectionError("lost connection")
+
+        self.driver.statements.append(sql)
+        sql = sql.replace('%s', '?').replace('`', '"').replace(' FOR UPDATE', '')
+        cursor = self.driver.db.execute(sql, args or ())
+        self.rows = cursor.fetchall()
+        self.rowcount = cursor.rowcount
+
+    async def fetchall(self):
+        return self.rows
+
+
+@pytest.fixture
+def driver():
+    return FakeDriver()
+
+
+@pytest.fixture
+def table(driver):
+    table = AsyncMysqlUserTable('user', 'password', 'db', 'users', 'localhost', 3306,
+                                connect=driver.connect)
+    table.password_hasher = PasswordHasher(algorithm='scrypt', scrypt_n=2 ** 10, workers=0)
+    return table
+
+
+def test_add_and_authenticate(table, driver):
+    async def scenario():
+        assert await table.add_user('Bob', 'pw')
+        assert not await table.add_user('bob', 'pw')
+
+        driver.statements.clear()
+        assert await table.authenticate('bob', 'pw', '10.0.0.1', 1000)
+        assert len(driver.statements) == 2  # SELECT, UPDATE
+        assert not await table.authenticate('bob', 'wrong', '10.0.0.1', 1000)
+        assert not await table.authenticate('nobody', 'pw', '10.0.0.1', 1000)
+
+        info = (await table.list_users(name='bob'))[0]
+        assert info.last_login_ip == '10.0.0.1'
+        await table.close()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize('change', [
+    lambda table: table.delete_user('nobody'),
+    lambda table: table.change_user_password('nobody', 'pw'),
+    lambda table: table.change_user_privileges('nobody', ['a']),
+    lambda table: table.add_user_privileges('nobody', ['a']),
+])
+def test_missing_user_in_one_statement(table, driver, change):
+    async def scenario():
+        driver.statements.clear()
+        with pytest.raises(ValueError):
+            await change(table)
+        assert len(driver.statements) == 1
+        await table.close()
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_privilege_changes(table):
+    async def scenario():
+        await table.add_user('bob', 'pw', ['default'])
+        await asyncio.gather(*(table.add_user_privileges('bob', [f'p{i}'])
+                               for i in range(20)))
+        assert len(await table.get_user_privileges('bob')) == 21
+
+        await asyncio.gather(*(table.remove_user_privileges('bob', [f'p{i}'])
+                               for i in range(20)))
+        assert await table.get_user_privileges('bob') == ['default']
+        await table.close()
+
+    asyncio.run(scenario())
+
+
+def test_changes_notify_listeners(table):
+    changed = []
+    table.add_change_listener(changed.append)
+
+    async def scenario():
+        await table.add_user('bob', 'pw')
+        await table.add_user_privileges('Bob', ['admin'])
+        await table.delete_user('bob')
+        await table.close()
+
+    asyncio.run(scenario())
+    assert changed == ['bob', 'bob']
+
+
+def test_retry_on_connection_error(table, driver):
+    async def scenario():
+        await table.add_user('bob', 'pw')
+        driver.failures = 1
+        assert await table.has_user('bob')
+
+        driver.failures = 2
+        with pytest.raises(ConnectionError):
+            await table.has_user('bob')
+        await table.close()
+
+    asyncio.run(scenario())
+
+
+def test_pool_checkout_timeout(driver):
+    async def scenario():
+        pool = AsyncConnectionPool(driver.connect, max_size=1, checkout_timeout=0.05)
+        async with pool.connection():
+            with pytest.raises(PoolTimeout):
+                async with pool.connection():
+                    pass
+        async with pool.connection():
+            pass
+        assert pool.stats()['checkouts'] == 2
+        await pool.close()
+
+    asyncio.run(scenario())
+
+
+def test_pool_reuses_idle_connections(driver):
+    async def scenario():
+        pool = AsyncConnectionPool(driver.connect, max_size=2)
+        for _ in range(3):
+            async with pool.connection():
+                pass
+        assert driver.connections == 1
+        await pool.close()
+
+    asyncio.run(scenario())
+
+
+def test_pool_discards_broken_connection(driver):
+    async def scenario():
+        pool = AsyncConnectionPool(driver.connect, health_check=lambda conn: conn.ping(False),
+                                   connection_errors=(ConnectionError,))
+        with pytest.raises(ConnectionError):
+            async with pool.connection() as conn:
+                conn.close()
+                raise ConnectionError("lost connection")
+        assert pool.stats()['size'] == 0
+
+        # Other errors don't cost a health check.
+        with pytest.raises(KeyError):
+            async with pool.connection() as conn:
+                conn.close()
+                raise KeyError()
+        assert pool.stats()['idle'] == 1
+        await pool.close()
+
+    asyncio.run(scenario())
+
+
+def test_pool_failed_connect_frees_the_slot(driver):
+    async def failing_connect():
+        raise ConnectionError("refused")
+
+    async def scenario():
+        pool = AsyncConnectionPool(failing_connect, max_size=1, checkout_timeout=0.05)
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                await pool.acquire()
+        assert pool.stats()['size'] == 0
+        assert pool.stats()['failures'] == 2
+
+    asyncio.run(scenario())
@@ -0,0 +1,64 @@
+import time
+
+from nslogin.utils.auth_cache import AuthCache
+
+
+def test_put_and_get():
+    cache = AuthCache()
+    cache.put("token", "admin", "Alice", True)
+    decision = cache.get("token", "admin")
+    assert decision.user == "alice" and decision.allowed
+    assert cache.get("token", "default") is None
+    assert cache.get("other", "admin") is None
+
+
+def test_expiry():
+    cache = AuthCache(ttl=10)
+    cache.put("token", "admin", "alice", True, expire_at=time.time() - 1)
+    assert cache.get("token", "admin") is None
+
+    cache.put("token", "admin", "alice", True, expire_at=time.time() + 3600)
+    assert cache.get("token", "admin").expire_at <= time.time() + 10
+
+
+def test_least_recently_used_is_evicted():
+    cache = AuthCache(max_size=2)
+    cache.put("a", "p", "alice", True)
+    cache.put("b", "p", "bob", True)
+    cache.get("a", "p")
+    cache.put("c", "p", "carol", True)
+    assert cache.get("a", "p") is not None
+    assert cache.get("b", "p") is None
+    assert cache.get("c", "p") is not None
+
+
+def test_invalidate_token():
+    cache = AuthCache()
+    cache.put("a", "p1", "alice", True)
+    cache.put("a", "p2", "alice", True)
+    cache.put("b", "p1", "alice", True)
+    cache.invalidate_token("a")
+    assert cache.get("a", "p1") is None and cache.get("a", "p2") is None
+    assert cache.get("b", "p1") is not None
+
+
+def test_invalidate_user():
+    cache = AuthCache()
+    cache.put("a", "p", "alice", True)
+    cache.put("b", "p", "alice", True)
+    cache.put("c", "p", "bob", True)
+    cache.invalidate_user("ALICE")
+    assert cache.get("a", "p") is None and cache.get("b", "p") is None
+    assert cache.get("c", "p") is not None
+
+
+def test_decision_made_before_invalidation_is_not_cached():
+    cache = AuthCache()
+    generation = cache.generation("alice")
+    # The privileges are revoked while the decision is being made.
+    cache.invalidate_user("alice")
+    cache.put("a", "admin", "alice", True, generation=generation)
+    assert cache.get("a", "admin") is None
+
+    cache.put("a", "admin", "alice", False, generation=cache.generation("Alice"))
+    assert cache.get("a", "admin").allowed is False
@@ -0,0 +1,126 @@
+import time
+import threading
+
+import pytest
+
+from nslogin.storage.connection_pool import ConnectionPool, PoolTimeout
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+        self.pings = 0
+
+    def ping(self):
+        self.pings += 1
+        if self.closed:
+            raise ConnectionError("closed")
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def connections():
+    return []
+
+
+@pytest.fixture
+def connect(connections):
+    def connect():
+        conn = FakeConnection()
+        connections.append(conn)
+        return conn
+    return connect
+
+
+def test_idle_connection_is_reused(connect, connections):
+    pool = ConnectionPool(connect, max_size=2)
+    for _ in range(3):
+        with pool.connection():
+            pass
+    assert len(connections) == 1
+    assert pool.stats()['checkouts'] == 3
+
+
+def test_checkout_timeout(connect):
+    pool = ConnectionPool(connect, max_size=1, checkout_timeout=0.05)
+    with pool.connection():
+        start = time.monotonic()
+        with pytest.raises(PoolTimeout):
+            pool.acquire()
+        assert time.monotonic() - start >= 0.05
+    with pool.connection():
+        pass
+
+
+def test_waiter_gets_released_connection(connect):
+    pool = ConnectionPool(connect, max_size=1, checkout_timeout=5)
+    conn = pool.acquire()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.acquire()))
+    waiter.start()
+    time.sleep(0.05)
+    pool.release(conn)
+    waiter.join()
+    assert got == [conn]
+
+
+def test_broken_connection_is_discarded(connect, connections):
+    pool = ConnectionPool(connect, health_check=FakeConnection.ping,
+                          connection_errors=(ConnectionError,))
+    with pytest.raises(ConnectionError):
+        with pool.connection() as conn:
+            conn.close()
+            raise ConnectionError("lost connection")
+    assert pool.stats()['size'] == 0
+    assert pool.stats()['failures'] == 1
+
+    with pool.connection() as conn:
+        assert conn is connections[1]
+
+
+def test_other_errors_skip_the_health_check(connect, connections):
+    pool = ConnectionPool(connect, health_check=FakeConnection.ping,
+                          health_check_after=60, connection_errors=(ConnectionError,))
+    with pytest.raises(KeyError):
+        with pool.connection():
+            raise KeyError()
+    assert connections[0].pings == 0
+    assert pool.stats()['idle'] == 1
+
+
+def test_idle_connection_checked_on_checkout(connect, connections):
+    pool = ConnectionPool(connect, health_check=FakeConnection.ping, health_check_after=0)
+    with pool.connection() as conn:
+        pass
+    conn.close()  # e.g. by the server's wait_timeout
+
+    with pool.connection() as conn:
+        assert conn is connections[1]
+    assert pool.stats()['size'] == 1
+
+
+def test_failed_connect_frees_the_slot():
+    def connect():
+        raise ConnectionError("refused")
+
+    pool = ConnectionPool(connect, max_size=1, checkout_timeout=0.05)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            pool.acquire()
+    assert pool.stats()['size'] == 0
+    assert pool.stats()['failures'] == 2
+
+
+def test_expired_idle_connections_are_closed(connect, connections):
+    pool = ConnectionPool(connect, min_size=1, max_size=3, idle_timeout=0)
+    first, second = pool.acquire(), pool.acquire()
+    pool.release(first)
+    pool.release(second)
+    time.sleep(0.01)
+
+    with pool.connection():
+        pass
+    assert first.closed
+    assert pool.stats()['size'] == 1
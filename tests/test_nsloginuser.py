@@ -0,0 +1,27 @@
+import pytest
+
+from nslogin.nsloginuser import parse_user_record
+
+
+def test_privileges_are_lowercased():
+    record = {'name': 'alice', 'password': 'pw', 'privileges': 'A, B'}
+    assert parse_user_record(record)[4] == ['a', 'b']
+
+    record = {'name': 'alice', 'password': 'pw', 'privileges': ['Admin', ' ']}
+    assert parse_user_record(record)[4] == ['admin']
+
+
+def test_default_privilege():
+    assert parse_user_record({'name': 'alice', 'password': 'pw'})[4] == ['default']
+
+
+@pytest.mark.parametrize('record', [
+    None,
+    {'name': 'evil:admin', 'password': 'pw'},
+    {'name': '1alice', 'password': 'pw'},
+    {'name': 'alice'},
+    {'name': 'alice', 'password': 'pw', 'password_hash': 'hash'},
+])
+def test_invalid_records(record):
+    with pytest.raises(ValueError):
+        parse_user_record(record)
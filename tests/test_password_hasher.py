@@ -0,0 +1,85 @@
+import pytest
+
+from nslogin.utils.password_hasher import PasswordHasher, decode, encode, is_kdf_hash
+
+
+@pytest.fixture
+def hasher():
+    return PasswordHasher(algorithm='scrypt', scrypt_n=2 ** 10, workers=0)
+
+
+def test_encode_decode_round_trip():
+    params = {'n': 1024, 'r': 8, 'p': 1}
+    encoded = encode('scrypt', params, b'\x00salt\xff', b'k' * 32)
+    assert encoded.startswith('$scrypt$n=1024,r=8,p=1$')
+    assert '=' not in encoded.split('$', 3)[3]
+    assert decode(encoded) == ('scrypt', params, b'\x00salt\xff', b'k' * 32)
+
+
+def test_hash_format(hasher):
+    encoded = hasher.hash("secret")
+    algorithm, params, salt, key = decode(encoded)
+    assert algorithm == 'scrypt'
+    assert params == {'n': 2 ** 10, 'r': 8, 'p': 1}
+    assert len(salt) == 16 and len(key) == 32
+    assert hasher.hash("secret") != encoded  # salted
+
+
+@pytest.mark.parametrize("algorithm, kwargs", [
+    ('scrypt', {'scrypt_n': 2 ** 10}),
+    ('pbkdf2-sha256', {'pbkdf2_iterations': 1000}),
+])
+def test_verify(algorithm, kwargs):
+    hasher = PasswordHasher(algorithm=algorithm, workers=0, **kwargs)
+    encoded = hasher.hash("pässword")
+    assert hasher.verify("pässword", encoded)
+    assert not hasher.verify("password", encoded)
+    assert not hasher.verify("", encoded)
+
+
+def test_verify_uses_parameters_of_the_hash(hasher):
+    old = PasswordHasher(algorithm='pbkdf2-sha256', pbkdf2_iterations=1000, workers=0)
+    assert hasher.verify("secret", old.hash("secret"))
+
+
+def test_tampered_hash_fails(hasher):
+    encoded = hasher.hash("secret")
+    prefix, key = encoded.rsplit('$', 1)
+    tampered = prefix + '$' + ('A' if key[0] != 'A' else 'B') + key[1:]
+    assert not hasher.verify("secret", tampered)
+
+
+def test_needs_rehash(hasher):
+    assert not hasher.needs_rehash(hasher.hash("secret"))
+    assert hasher.needs_rehash(
+        PasswordHasher(algorithm='scrypt', scrypt_n=2 ** 11, workers=0).hash("secret"))
+    assert hasher.needs_rehash(
+        PasswordHasher(algorithm='pbkdf2-sha256', pbkdf2_iterations=1000, workers=0).hash("x"))
+    assert hasher.needs_rehash("5e884898da28047151d0e56f8dc6292773603d0d6aabbdd62a11ef721d1542d8")
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("$scrypt$n=1024,r=8,p=1$c2FsdA$a2V5", True),
+    ("$pbkdf2-sha256$i=1000$c2FsdA$a2V5", True),
+    ("$bcrypt$whatever", False),
+    ("5e884898da28047151d0e56f8dc62927", False),
+    ("", False),
+    (None, False),
+])
+def test_is_kdf_hash(value, expected):
+    assert is_kdf_hash(value) is expected
+
+
+def test_unsupported_algorithm():
+    with pytest.raises(ValueError):
+        PasswordHasher(algorithm='md5')
+
+
+def test_process_pool():
+    hasher = PasswordHasher(algorithm='pbkdf2-sha256', pbkdf2_iterations=1000, workers=2)
+    try:
+        futures = [hasher.hash_future(f"password{i}") for i in range(4)]
+        hashes = [future.result() for future in futures]
+        assert all(hasher.verify(f"password{i}", h) for i, h in enumerate(hashes))
+    finally:
+        hasher.close()
@@ -0,0 +1,96 @@
+import pytest
+
+from nslogin.storage.privilege_rule import parse_rule
+from nslogin.storage.privileges import PrivilegeIndex
+
+
+@pytest.fixture
+def index():
+    index = PrivilegeIndex()
+    index.mask_of(['a', 'b', 'c', 'guest'])
+    return index
+
+
+def allowed(index, rule, privileges):
+    return index.compile(rule)(index.mask_of(privileges))
+
+
+def test_parse_names_are_lowercased():
+    assert parse_rule("Admin") == ('name', 'admin')
+
+
+def test_empty_rule_is_default():
+    assert parse_rule("") == ('name', 'default')
+    assert parse_rule("   ") == ('name', 'default')
+
+
+def test_and_binds_tighter_than_or():
+    assert parse_rule("a|b&c") == ('or', [('name', 'a'), ('and', [('name', 'b'), ('name', 'c')])])
+    assert parse_rule("a&b|c") == ('or', [('and', [('name', 'a'), ('name', 'b')]), ('name', 'c')])
+
+
+def test_slash_is_and():
+    assert parse_rule("a/b") == parse_rule("a&b")
+    assert parse_rule("a/b|c") == parse_rule("(a&b)|c")
+
+
+def test_not_binds_tighter_than_and():
+    assert parse_rule("!a&b") == ('and', [('not', ('name', 'a')), ('name', 'b')])
+    assert parse_rule("!!a") == ('not', ('not', ('name', 'a')))
+
+
+def test_parentheses():
+    assert parse_rule("(a|b)&c") == ('and', [('or', [('name', 'a'), ('name', 'b')]), ('name', 'c')])
+    assert parse_rule(" ( a ) ") == ('name', 'a')
+
+
+@pytest.mark.parametrize("rule", [
+    "a&", "|a", "a||b", "a&&b", "(a", "a)", "()", "(a|b", "a(b)", "!", "a b",
+])
+def test_malformed_rules_raise(rule):
+    with pytest.raises(ValueError):
+        parse_rule(rule)
+
+
+@pytest.mark.parametrize("rule", ["a&", "(a|b", "a||b", "a)", "!"])
+def test_malformed_rules_deny(index, rule):
+    assert not allowed(index, rule, ['a', 'b', 'c', 'guest'])
+
+
+@pytest.mark.parametrize("rule, privileges, expected", [
+    ("a|b&c", ['a'], True),
+    ("a|b&c", ['b'], False),
+    ("a|b&c", ['b', 'c'], True),
+    ("(a|b)&c", ['a'], False),
+    ("(a|b)&c", ['a', 'c'], True),
+    ("a/b", ['a'], False),
+    ("a/b", ['a', 'b'], True),
+    ("!guest", ['a'], True),
+    ("!guest", ['a', 'guest'], False),
+    ("(a|b)&!guest", ['b', 'guest'], False),
+    ("A&B", ['a', 'b'], True),
+])
+def test_evaluation(index, rule, privileges, expected):
+    assert allowed(index, rule, privileges) is expected
+
+
+def test_unknown_names(index):
+    # A privilege nobody holds is never granted, so its negation always is.
+    assert not allowed(index, "unknown", ['a', 'b', 'c', 'guest'])
+    assert allowed(index, "!unknown", [])
+    assert allowed(index, "a&!unknown", ['a'])
+    assert not allowed(index, "a&unknown", ['a'])
+    assert allowed(index, "a|unknown", ['a'])
+    assert 'unknown' not in index.bits
+
+
+def test_privilege_lists_require_all(index):
+    assert index.compile(('a', 'b'))(index.mask_of(['a', 'b']))
+    assert not index.compile(('a', 'b'))(index.mask_of(['a']))
+    assert not index.compile(('a', 'unknown'))(index.mask_of(['a']))
+
+
+def test_rule_recompiled_once_name_is_interned(index):
+    assert not allowed(index, "a&new", ['a'])
+    index.intern('new')
+    assert allowed(index, "a&new", ['a', 'new'])
@@ -0,0 +1,56 @@
+import pytest
+
+from nslogin.utils.rate_limit import LoginRateLimit, TokenBuckets
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('nslogin.utils.rate_limit.time.monotonic', lambda: now[0])
+    return now
+
+
+def test_burst_then_refill(clock):
+    limit = LoginRateLimit(ip_rate=1, ip_burst=3, user_rate=100, user_burst=100)
+    assert all(limit.allow("10.0.0.1", "alice") for _ in range(3))
+    assert not limit.allow("10.0.0.1", "alice")
+
+    clock[0] += 1
+    assert limit.allow("10.0.0.1", "alice")
+    assert not limit.allow("10.0.0.1", "alice")
+
+
+def test_per_ip_and_per_user(clock):
+    limit = LoginRateLimit(ip_rate=0, ip_burst=2, user_rate=0, user_burst=3)
+    assert limit.allow("10.0.0.1", "alice")
+    assert limit.allow("10.0.0.1", "bob")
+    assert not limit.allow("10.0.0.1", "carol")  # this address is out
+
+    assert limit.allow("10.0.0.2", "Alice")
+    assert limit.allow("10.0.0.3", "ALICE")
+    assert not limit.allow("10.0.0.4", "alice")  # this user is out
+
+
+def test_refused_attempt_takes_no_token(clock):
+    limit = LoginRateLimit(ip_rate=0, ip_burst=5, user_rate=0, user_burst=1)
+    assert limit.allow("10.0.0.1", "alice")
+    for _ in range(10):
+        assert not limit.allow("10.0.0.1", "alice")
+    # The address still has its tokens for another user.
+    assert limit.allow("10.0.0.1", "bob")
+
+
+def test_least_recently_used_bucket_is_dropped():
+    buckets = TokenBuckets(rate=0, burst=1, max_keys=2)
+    buckets.take("a", 0)
+    buckets.take("b", 0)
+    buckets.take("c", 0)
+    assert list(buckets.buckets) == ["b", "c"]
+    assert buckets.peek("a", 0) == 1
+
+
+def test_from_config():
+    limit = LoginRateLimit.from_config({'per_ip': {'rate': 2, 'burst': 4},
+                                        'per_user': {'burst': 1}})
+    assert (limit.ip_buckets.rate, limit.ip_buckets.burst) == (2, 4)
+    assert (limit.user_buckets.rate, limit.user_buckets.burst) == (0.1, 1)
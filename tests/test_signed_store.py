@@ -0,0 +1,99 @@
+import time
+import base64
+
+import pytest
+
+from nslogin.session.signed_store import SignedSessionStore, b64decode, b64encode
+from nslogin.storage.user_table import check_user_name
+
+
+@pytest.fixture
+def store():
+    return SignedSessionStore("secret", life_time=3600)
+
+
+def test_round_trip(store):
+    record = store.new_session("alice", time.time())
+    login = store.get(record.token)
+    assert login.user == "alice"
+    assert login.token == record.token
+    assert abs(login.login_at - record.login_at) < 0.001
+
+
+def test_other_replica_with_same_secret(store):
+    token = store.new_session("alice", time.time()).token
+    assert SignedSessionStore("secret", life_time=3600).get(token).user == "alice"
+    assert SignedSessionStore("other secret", life_time=3600).get(token) is None
+
+
+def test_tampered_payload(store):
+    token = store.new_session("alice", time.time()).token
+    payload, signature = token.split(".")
+    issued_at, _ = b64decode(payload).decode().split(":")
+    forged = b64encode(f"{issued_at}:admin".encode())
+    assert store.get(f"{forged}.{signature}") is None
+
+
+def test_tampered_signature(store):
+    token = store.new_session("alice", time.time()).token
+    payload, signature = token.split(".")
+    flipped = bytearray(b64decode(signature))
+    flipped[0] ^= 1
+    assert store.get(f"{payload}.{b64encode(bytes(flipped))}") is None
+
+
+def test_extended_lifetime_is_refused(store):
+    # Moving the issue time forward invalidates the signature.
+    token = store.new_session("alice", time.time() - 7200).token
+    payload, signature = token.split(".")
+    forged = b64encode(f"{int(time.time() * 1000)}:alice".encode())
+    assert store.get(f"{forged}.{signature}") is None
+
+
+@pytest.mark.parametrize("token", [
+    "", "garbage", "a.b", "a.b.c", "!!!.???",
+    base64.urlsafe_b64encode(b"no-colon").decode() + ".AAAA",
+])
+def test_malformed_tokens(store, token):
+    assert store.get(token) is None
+
+
+def test_expired(store):
+    assert store.get(store.new_session("alice", time.time() - 3601).token) is None
+    assert store.get(store.new_session("alice", time.time() - 3500).token) is not None
+
+
+def test_logout_revokes_only_that_token(store):
+    first = store.new_session("alice", time.time() - 10).token
+    second = store.new_session("alice", time.time()).token
+    store.remove(first)
+    assert store.get(first) is None
+    assert store.get(second) is not None
+
+
+def test_remove_user_revokes_earlier_tokens(store):
+    old = store.new_session("alice", time.time() - 10).token
+    other = store.new_session("bob", time.time() - 10).token
+    store.remove_user("Alice")
+    assert store.get(old) is None
+    assert store.get(other) is not None
+    assert store.get(store.new_session("alice", time.time() + 1).token) is not None
+
+
+def test_token_of_previous_format_is_refused(store):
+    # Tokens used to carry a privilege version between time and user.
+    payload = f"{int(time.time() * 1000)}:0badf00d:alice".encode()
+    token = f"{b64encode(payload)}.{b64encode(store.sign(payload))}"
+    assert store.get(token) is None
+
+
+def test_colon_in_user_name_does_not_switch_user(store):
+    # Such names can't be registered, and must not yield another user's
+    # session if one was.
+    assert store.get(store.new_session("evil:admin", time.time()).token) is None
+
+
+def test_colon_in_user_name_is_rejected():
+    with pytest.raises(ValueError):
+        check_user_name("evil:admin")
+    check_user_name("alice")
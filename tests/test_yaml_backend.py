@@ -0,0 +1,148 @@
+import os
+
+import yaml
+import pytest
+
+from nslogin.storage.backends.yaml_backend import YamlUserTable
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / "users.yaml")
+    table = YamlUserTable(path)
+    table.add_users([("a", "hash-a", "", ["x"]), ("b", "hash-b", "", ["y"])])
+    table.close()
+    return path
+
+
+def read_file(path):
+    with open(path) as f:
+        return yaml.safe_load(f)
+
+
+@pytest.fixture
+def write_behind(path):
+    table = YamlUserTable(path)
+    table.start_write_behind(interval=3600, threshold=10000)
+    yield table
+    table.close()
+
+
+def test_pending_login_keeps_privileges_changed_elsewhere(path, write_behind):
+    write_behind.update_user_login_info("a", "10.0.0.1", 1000)
+
+    other = YamlUserTable(path)
+    other.change_user_privileges("a", ["admin"])
+    other.close()
+
+    write_behind.flush()
+    users = read_file(path)
+    assert users["a"]["privilege"] == ["admin"]
+    assert users["a"]["last_login_ip"] == "10.0.0.1"
+    assert write_behind.get_user_privileges("a") == ["admin"]
+
+
+def test_pending_login_keeps_revocation_made_elsewhere(path, write_behind):
+    write_behind.update_user_login_info("a", "10.0.0.1", 1000)
+
+    other = YamlUserTable(path)
+    other.remove_user_privileges("a", ["x"])
+    other.close()
+
+    write_behind.reload()
+    assert write_behind.get_user_privileges("a") == []
+    write_behind.flush()
+    assert read_file(path)["a"]["privilege"] == []
+
+
+def test_pending_password_change_is_kept(path, write_behind):
+    write_behind.password_hasher.hash = lambda password: f"hashed-{password}"
+    write_behind.change_user_password("a", "new")
+
+    other = YamlUserTable(path)
+    other.add_user_privileges("a", ["admin"])
+    other.close()
+
+    write_behind.flush()
+    users = read_file(path)
+    assert users["a"]["password_hash"] == "hashed-new"
+    assert users["a"]["privilege"] == ["x", "admin"]
+
+
+def test_pending_addition_and_deletion_are_kept(path, write_behind):
+    write_behind.add_users([("c", "hash-c", "", ["z"])])
+    write_behind.delete_user("b")
+
+    other = YamlUserTable(path)
+    other.add_user_privileges("a", ["admin"])
+    other.close()
+
+    write_behind.flush()
+    assert sorted(read_file(path)) == ["a", "c"]
+
+
+def test_user_deleted_elsewhere_stays_deleted(path, write_behind):
+    write_behind.update_user_login_info("a", "10.0.0.1", 1000)
+
+    other = YamlUserTable(path)
+    other.delete_user("a")
+    other.close()
+
+    write_behind.flush()
+    assert "a" not in read_file(path)
+    assert not write_behind.has_user("a")
+
+
+@pytest.fixture
+def journal(path):
+    table = YamlUserTable(path)
+    table.start_journal(compact_threshold=1000)
+    table.password_hasher.hash = lambda password: f"hashed-{password}"
+    yield table
+    table.close()
+
+
+def test_journal_entries_are_replayed(path, journal):
+    journal.add_user_privileges("a", ["admin"])
+    journal.add_user("e", "password")
+    journal.delete_user("b")
+
+    assert read_file(path)["a"]["privilege"] == ["x"]
+    table = YamlUserTable(path)
+    assert sorted(user.name for user in table.list_users()) == ["a", "e"]
+    assert table.get_user_privileges("a") == ["x", "admin"]
+
+
+def test_journal_is_compacted(path, journal):
+    journal.journal_compact_threshold = 3
+    for privilege in ("p1", "p2", "p3"):
+        journal.add_user_privileges("a", [privilege])
+
+    assert read_file(path)["a"]["privilege"] == ["x", "p1", "p2", "p3"]
+    assert journal.journal_entries == 0
+    with open(journal.journal_file) as f:
+        assert f.read() == ""
+
+
+def test_journal_kept_by_writer_without_journal(path, journal):
+    journal.add_user_privileges("a", ["admin"])
+
+    other = YamlUserTable(path)
+    other.delete_user("b")
+    other.close()
+
+    journal.add_user("e", "password")
+    table = YamlUserTable(path)
+    assert sorted(user.name for user in table.list_users()) == ["a", "e"]
+    assert table.get_user_privileges("a") == ["x", "admin"]
+
+
+def test_removed_journal_is_reopened(path, journal):
+    journal.add_user_privileges("a", ["admin"])
+    other = YamlUserTable(path)
+    other.save_to_file()
+    other.close()
+    os.remove(journal.journal_file)
+
+    journal.add_user("e", "password")
+    assert YamlUserTable(path).has_user("e")